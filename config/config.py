@@ -3,6 +3,7 @@ Flask Configuration File
 """
 import os
 import yaml
+import multiprocessing
 from pathlib import Path
 
 FILE_PATH = Path(__file__)
@@ -11,7 +12,8 @@ CONFIG_DIRECTORY = str(PARENT_PATH.resolve())
 SECRET_FILE_PATH = str(PARENT_PATH / 'secrets.yaml')
 try:
     with open(SECRET_FILE_PATH, 'r') as secret_file:
-        secrets = yaml.load(secret_file)
+        # libyaml's loader, where PyYAML was built with it, is much faster
+        secrets = yaml.load(secret_file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 except IOError:
     print("No secret file found. Create your own secret file based on 'config/example-secrets.yaml'.")
     raise SystemError()
@@ -19,6 +21,9 @@ except IOError:
 class Config(object):
     # TODO: it is up to you to decide when to increment version numbers
     VERSION = '0.1.0'
+    # What this process serves: 'lti' (the LTI endpoints), 'admin' (the
+    # admin pages and exports) or 'all'; the others are never imported
+    WORKER_ROLE = os.environ.get('WORKER_ROLE', 'all')
     DEBUG = False
     TESTING = False
     CSRF_ENABLED = True
@@ -31,6 +36,19 @@ class Config(object):
     STATIC_DIRECTORY = str(PARENT_PATH / 'static')
     BLOCKLY_LOG_DIR = str(PARENT_PATH / 'logs')
     
+    # Log records are queued by request threads and written in batches by a
+    # background thread; interactions go to a JSON-lines file, rotated when it
+    # reaches INTERACTION_LOG_MAX_BYTES or INTERACTION_LOG_MAX_AGE seconds
+    ASYNC_LOGGING = True
+    LOG_QUEUE_SIZE = 100000
+    INTERACTION_LOG_FILE = os.path.join(BLOCKLY_LOG_DIR, 'interactions.jsonl')
+    INTERACTION_LOG_MAX_BYTES = 50 * 1024 * 1024
+    INTERACTION_LOG_MAX_AGE = 24 * 3600
+    INTERACTION_LOG_BACKUPS = 10
+    # Statements taking longer than SLOW_QUERY_THRESHOLD seconds are logged here
+    SLOW_QUERY_THRESHOLD = 0.1
+    SLOW_QUERY_LOG_FILE = os.path.join(BLOCKLY_LOG_DIR, 'slow_queries.log')
+    
     # secret key for flask authentication
     SECRET_KEY = secrets['FLASK_SECRET_KEY']
     
@@ -67,6 +85,89 @@ class Config(object):
     SECURITY_DEFAULT_REMEMBER_ME = True
     
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Commit each request's changes once, when it finishes, instead of every
+    # time a model helper creates something (and roll them back on errors)
+    UNIT_OF_WORK = True
+    
+    # Run on every new SQLite connection: WAL lets reads proceed during a
+    # write, and writers wait busy_timeout ms for the lock instead of failing
+    SQLITE_PRAGMAS = (('busy_timeout', 5000), ('journal_mode', 'WAL'),
+                      ('synchronous', 'NORMAL'), ('mmap_size', 256 * 1024 * 1024))
+    # Connection pool for server databases (MySQL, PostgreSQL)
+    DATABASE_POOL_SIZE = 10
+    DATABASE_MAX_OVERFLOW = 20
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_PRE_PING = True
+    # Read-only views (assignment lookups, the assignment picker, the admin
+    # lists) query one of the SQLALCHEMY_BINDS named here, at random, until
+    # they write; e.g. SQLALCHEMY_BINDS = {'replica': 'sqlite:///replica.db'}
+    # with SQLALCHEMY_REPLICA_BINDS = ['replica'], kept current locally with
+    # `manage.py sync_replicas`. Empty sends every query to the primary.
+    SQLALCHEMY_BINDS = {}
+    SQLALCHEMY_REPLICA_BINDS = []
+    
+    # How many resolved LTI users/courses each process remembers, and for how
+    # many seconds, before asking the database again
+    IDENTITY_CACHE_SIZE = 10000
+    IDENTITY_CACHE_TTL = 600
+    
+    # Client events are written in batches of LOG_SINK_BATCH_SIZE rows, or
+    # every LOG_SINK_INTERVAL seconds; at most LOG_SINK_MAX_QUEUE are held
+    LOG_SINK_BATCH_SIZE = 200
+    LOG_SINK_INTERVAL = 0.5
+    LOG_SINK_MAX_QUEUE = 10000
+    
+    # Grades are posted to the LMS by background workers, retrying failures
+    # with exponential backoff starting at GRADE_DISPATCH_BASE_DELAY seconds
+    GRADE_DISPATCH_WORKERS = 4
+    GRADE_DISPATCH_MAX_ATTEMPTS = 6
+    GRADE_DISPATCH_BASE_DELAY = 1.0
+    # Serve a stand-in LMS outcome service at /outcome_stub/ (never in production)
+    GRADE_OUTCOME_STUB = False
+    GRADE_OUTCOME_STUB_DELAY = 0
+    
+    # Highlighted grade feedback is cached up to HIGHLIGHT_CACHE_SIZE bytes (of
+    # UTF-8); submissions longer than HIGHLIGHT_MAX_LENGTH characters are
+    # truncated before lexing
+    HIGHLIGHT_CACHE_ENTRIES = 4096
+    HIGHLIGHT_CACHE_SIZE = 8 * 1024 * 1024
+    HIGHLIGHT_MAX_LENGTH = 20000
+    
+    # Rendered assignment pickers (select/share) are cached per course, up to
+    # ASSIGNMENT_PICKER_CACHE_SIZE bytes (of UTF-8); other processes see a
+    # change after at most ASSIGNMENT_PICKER_CACHE_TTL seconds
+    ASSIGNMENT_PICKER_CACHE_ENTRIES = 1024
+    ASSIGNMENT_PICKER_CACHE_SIZE = 16 * 1024 * 1024
+    ASSIGNMENT_PICKER_CACHE_TTL = 60
+    
+    # Where session data lives: 'cookie' (Flask's signed cookie), 'memory'
+    # (per-process, single process deployments only) or 'sqlite' (a file
+    # shared by all processes on this machine)
+    SESSION_BACKEND = 'cookie'
+    SESSION_MEMORY_MAX_ENTRIES = 100000
+    SESSION_SQLITE_PATH = str(PARENT_PATH.parent / 'database' / 'sessions.db')
+    
+    # Student code is written once they pause for SAVE_CODE_QUIET_PERIOD
+    # seconds, or every SAVE_CODE_MAX_DELAY seconds; 0 writes every save
+    SAVE_CODE_QUIET_PERIOD = 2.0
+    SAVE_CODE_MAX_DELAY = 10.0
+    
+    # Each worker process writes its request metrics to a file in METRICS_DIR
+    # every METRICS_FLUSH_INTERVAL seconds; /metrics adds them all up
+    METRICS_DIR = str(PARENT_PATH.parent / 'database' / 'metrics')
+    METRICS_FLUSH_INTERVAL = 1.0
+    
+    # serve.py: SERVE_WORKERS processes (process mode; one per CPU unless
+    # set) of SERVE_THREADS threads, or SERVE_GEVENT_CONNECTIONS greenlets
+    # (gevent mode). When stopping, requests get SERVE_DRAIN_TIMEOUT seconds
+    # to finish, and new ones are told to retry after SERVE_RETRY_AFTER
+    # seconds.
+    SERVE_WORKERS = multiprocessing.cpu_count()
+    SERVE_THREADS = 8
+    SERVE_GEVENT_CONNECTIONS = 1000
+    SERVE_DRAIN_TIMEOUT = 30
+    SERVE_RETRY_AFTER = 5
 
     
 class ProductionConfig(Config):
@@ -79,5 +180,6 @@ class TestingConfig(Config):
     PORT = 5001
     HOST = 'localhost'
     SITE_ROOT_URL = 'localhost:5001'
+    GRADE_OUTCOME_STUB = True
     # TODO: set your database URI, e.g., for MySQL or PostGres
     SQLALCHEMY_DATABASE_URI = 'sqlite:///test.db'
@@ -1,33 +1,116 @@
 import os
+import time
 
 # Flask tools
-from flask import g
+from flask import g, session, request
 from flask_security.core import current_user
 
 # Application specific
 from main import app
+from models.models import (Course, in_unit_of_work, begin_unit_of_work,
+                           end_unit_of_work)
+from controllers.sessions import install_session_interface
+from controllers import profiling
+from controllers.utility import request_metrics
 
-# Add the current user to the global g object
+# Keep session data on the server if so configured
+install_session_interface(app)
+
+# Count each request, and time it, for /metrics
+app.before_first_request(request_metrics.open)
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.time()
+    request_metrics.start_request()
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exception=None):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        error = exception is not None or getattr(g, 'response_status', 500) >= 500
+        stats = getattr(g, 'query_stats', None)
+        if stats is None:
+            request_metrics.finish_request(request.endpoint, time.time() - started, error)
+        else:
+            request_metrics.finish_request(request.endpoint, time.time() - started, error,
+                                           stats.count, stats.total_time)
+
+# Count the queries (and their time) each request makes, including load_user's
+@app.before_request
+def start_query_profile():
+    profiling.start_request()
+
+@app.after_request
+def finish_query_profile(response):
+    return profiling.finish_request(response)
+
+# Commit each request's changes once, as it finishes; registered after the
+# profiling hooks so that the commit is counted
+@app.before_request
+def start_unit_of_work():
+    if app.config.get('UNIT_OF_WORK', True):
+        begin_unit_of_work()
+
+@app.after_request
+def commit_unit_of_work(response):
+    if in_unit_of_work():
+        end_unit_of_work(commit=response.status_code < 500)
+    return response
+
+@app.teardown_request
+def abandon_unit_of_work(exception=None):
+    # The request failed before its response was made
+    if in_unit_of_work():
+        end_unit_of_work(commit=False)
+
+# Add the current user (and their roles) to the global g object
 @app.before_request
 def load_user():
     if current_user.is_authenticated:
         g.user = current_user
+        g.roles = current_user.role_names()
         if 'lti_course' in session:
             g.course = Course.by_id(session['lti_course'])
     else:
         g.user = None
+        g.roles = frozenset()
         
-# Import any administrative aspects, including your database interface
-from controllers.admin import admin
-
 # Import security handling stuff
 import controllers.security 
 
 # Useful routes
 import controllers.utility
 
-# Below you should import all of your controllers and register their blueprint
-# ...
+# Turning requests away, and flushing background work, when the server stops
+import controllers.lifecycle
+
+# Only what this worker's role needs is imported (see WORKER_ROLE), so that
+# LTI workers start without Flask-Admin and its views
+WORKER_ROLES = {'lti': ('lti',),
+                'admin': ('admin', 'exports'),
+                'all': ('lti', 'admin', 'exports')}
+role = app.config.get('WORKER_ROLE', 'all')
+if role not in WORKER_ROLES:
+    raise ValueError("Unknown WORKER_ROLE {!r}; expected one of {}".format(
+                     role, ', '.join(sorted(WORKER_ROLES))))
+
+if 'admin' in WORKER_ROLES[role]:
+    # Import any administrative aspects, including your database interface
+    from controllers.admin import admin
+
+if 'exports' in WORKER_ROLES[role]:
+    # Bulk export of a course's submissions and logs
+    import controllers.exports
+
+if 'lti' in WORKER_ROLES[role]:
+    from controllers.lti import lti_assignments
+    app.register_blueprint(lti_assignments)
 
 @app.route("/", methods=['GET', 'POST'])
 def index():
@@ -6,16 +6,18 @@ have a route for remotely shutting down my server.
 
 # Import Flask
 from flask import g, request, url_for
-from flask_admin import Admin
+from flask_admin import Admin, expose
 from flask_admin.contrib.sqla import ModelView
 from jinja2 import Markup
 
 # Import runestone
 from main import app
 from controllers.helpers import admin_required
+from controllers.lifecycle import request_shutdown
 from models.models import (User, db, Course, Submission, Assignment, 
                            AssignmentGroup, AssignmentGroupMembership, Settings,
                            Authentication, Role)
+from models.engine import replica_reads
 
 admin = Admin(app)
 
@@ -27,6 +29,12 @@ class RequireAdminView(ModelView):
         if g.user:
             return g.user.is_admin()
         return False
+    
+    @expose('/')
+    @replica_reads
+    def index_view(self):
+        # The list pages only read, so a replica can serve them
+        return super(RequireAdminView, self).index_view()
         
 class UserView(RequireAdminView):
     '''
@@ -114,11 +122,14 @@ admin.add_view(RoleView(Role, db.session, category='Tables'))
 def shutdown():
     '''
     A most dangerous route with limited practical purpose. Accessing this
-    URL as the admin will shutdown your server, remotely.
+    URL as the admin will shutdown your server, remotely: under serve.py it
+    stops taking requests, lets the running ones finish and writes out any
+    pending work; under Werkzeug's development server (manage.py secure or
+    insecure) it stops that server, as it always has.
     '''
-    func = request.environ.get('werkzeug.server.shutdown')
-    if func is None:
-        raise RuntimeError('Not running with the Werkzeug Server')
-    func()
+    if not request_shutdown():
+        func = request.environ.get('werkzeug.server.shutdown')
+        if func is None:
+            raise RuntimeError('Not running with serve.py or the Werkzeug Server')
+        func()
     return 'Server shutting down...'
-    
\ No newline at end of file
@@ -0,0 +1,63 @@
+'''
+Conditional GET support for the polled read endpoints.
+
+Endpoints first load only the validators of what they are about to send (ids,
+`version` and `date_modified` columns) and ask `not_modified` whether the
+client's copy is still current. If it is, a 304 goes back without the full row
+ever being loaded or serialized; otherwise the endpoint builds its response as
+usual and passes it through `with_validators`.
+
+    validators = Assignment.validators(assignment_id)
+    etag = make_etag('assignment', *validators)
+    unchanged = not_modified(etag, validators.date_modified)
+    if unchanged is not None:
+        return unchanged
+    ...
+    return with_validators(jsonify(...), etag, validators.date_modified)
+'''
+
+import hashlib
+
+from flask import request, Response
+
+from main import app
+
+
+def make_etag(*parts):
+    '''
+    A strong ETag for the given values, which must change whenever the
+    response would. The application version is included, so that a deploy
+    that changes the response format also changes every ETag.
+    '''
+    text = '|'.join(str(part) for part in (app.config['VERSION'],) + parts)
+    return '"{}"'.format(hashlib.sha1(text.encode('utf-8')).hexdigest())
+
+
+def not_modified(etag, last_modified=None):
+    '''
+    A 304 response if the request's If-None-Match (or, failing that, its
+    If-Modified-Since) shows the client already has this version; else None.
+    '''
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if request.if_none_match:
+        unchanged = request.if_none_match.contains(etag.strip('"'))
+    elif request.if_modified_since and last_modified is not None:
+        unchanged = last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+    else:
+        unchanged = False
+    if not unchanged:
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+def with_validators(response, etag, last_modified=None):
+    '''
+    Attach the ETag and Last-Modified to `response`; clients must revalidate
+    before every reuse, since these endpoints are polled for changes.
+    '''
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,198 @@
+'''
+Bulk export of a course's submissions and logs.
+
+Rows are read with `yield_per`, so the database driver streams them in
+batches instead of loading the whole course, and each batch is encoded (as
+CSV, JSON lines, or files in a zip of student code) and handed on before the
+next is read. The routes send the chunks as a streamed response, and the
+`export` manage command writes them to a file; either way memory use does not
+grow with the size of the course.
+'''
+
+import csv
+import json
+import zipfile
+
+from flask import g, abort, session, Response, stream_with_context
+from pylti.common import LTI_SESSION_KEY
+
+from main import app
+from models.models import (db, Assignment, Course, Role, Submission, Log, User,
+                           code_buffer)
+
+try:
+    # Python 2's csv module only writes byte strings
+    from StringIO import StringIO
+    def _csv_value(value):
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+except ImportError:
+    from io import StringIO
+    def _csv_value(value):
+        return value
+
+BATCH_SIZE = 1000
+
+SUBMISSION_COLUMNS = (('id', Submission.id), ('assignment_id', Submission.assignment_id),
+                      ('assignment_name', Assignment.name), ('user_id', Submission.user_id),
+                      ('correct', Submission.correct), ('status', Submission.status),
+                      ('version', Submission.version),
+                      ('assignment_version', Submission.assignment_version),
+                      ('date_created', Submission.date_created),
+                      ('date_modified', Submission.date_modified), ('code', Submission.code))
+LOG_COLUMNS = (('id', Log.id), ('assignment_id', Log.assignment_id), ('user_id', Log.user_id),
+               ('event', Log.event), ('action', Log.action), ('date_created', Log.date_created))
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson', 'zip': 'application/zip'}
+
+
+def submission_rows(course_id, batch_size=BATCH_SIZE):
+    # Buffered code would otherwise be missing from the export
+    code_buffer.flush()
+    return (db.session.query(*[column for name, column in SUBMISSION_COLUMNS])
+                      .join(Assignment, Assignment.id == Submission.assignment_id)
+                      .filter(Assignment.course_id == course_id)
+                      .order_by(Submission.id)
+                      .yield_per(batch_size))
+
+
+def log_rows(course_id, batch_size=BATCH_SIZE):
+    return (db.session.query(*[column for name, column in LOG_COLUMNS])
+                      .join(Assignment, Assignment.id == Log.assignment_id)
+                      .filter(Assignment.course_id == course_id)
+                      .order_by(Log.id)
+                      .yield_per(batch_size))
+
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(columns, rows, batch_size=BATCH_SIZE):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, column in columns])
+    for batch in _batches(rows, batch_size):
+        writer.writerows([[_csv_value(value) for value in row] for row in batch])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def jsonl_chunks(columns, rows, batch_size=BATCH_SIZE):
+    names = [name for name, column in columns]
+    for batch in _batches(rows, batch_size):
+        yield ''.join(json.dumps(dict(zip(names, row)), default=str, sort_keys=True) + '\n'
+                      for row in batch)
+
+
+class _ChunkWriter(object):
+    '''
+    Collects what zipfile writes, so it can be sent on as it is produced;
+    having no seek() makes zipfile write in a single forward pass.
+    '''
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def zip_chunks(rows, batch_size=BATCH_SIZE):
+    '''
+    Every submission's code, as assignment-<id>/user-<id>.py in a zip.
+    '''
+    names = [name for name, column in SUBMISSION_COLUMNS]
+    writer = _ChunkWriter()
+    archive = zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED)
+    for batch in _batches(rows, batch_size):
+        for row in batch:
+            submission = dict(zip(names, row))
+            archive.writestr('assignment-{}/user-{}.py'.format(submission['assignment_id'],
+                                                               submission['user_id']),
+                             (submission['code'] or '').encode('utf-8'))
+        yield writer.take()
+    archive.close()
+    yield writer.take()
+
+
+def export_chunks(course_id, kind, format):
+    '''
+    The chunks of one export: `kind` is 'submissions' or 'logs', and `format`
+    is 'csv', 'jsonl' or, for submissions only, 'zip'.
+    '''
+    if kind == 'submissions':
+        columns, rows = SUBMISSION_COLUMNS, submission_rows(course_id)
+    elif kind == 'logs':
+        columns, rows = LOG_COLUMNS, log_rows(course_id)
+    else:
+        raise ValueError("Unknown export: {}".format(kind))
+    if format == 'csv':
+        return csv_chunks(columns, rows)
+    elif format == 'jsonl':
+        return jsonl_chunks(columns, rows)
+    elif format == 'zip' and kind == 'submissions':
+        return zip_chunks(rows)
+    raise ValueError("Cannot export {} as {}".format(kind, format))
+
+
+def can_export(user, course_id):
+    if user is None:
+        return False
+    if user.is_admin():
+        return True
+    course = Course.by_id(course_id)
+    if course is not None and course.owner_id == user.id:
+        return True
+    return (Role.query.filter_by(user_id=user.id, course_id=course_id, name='instructor')
+                      .first() is not None)
+
+
+def lti_can_export(course_id):
+    '''
+    Whether the current LTI session is an instructor's launch from this
+    course; LTI users are never logged in to Flask-Security, so `g.user` is
+    None for them.
+    '''
+    if not session.get(LTI_SESSION_KEY, False) or not session.get('context_id'):
+        return False
+    course = Course.query.filter_by(external_id=session['context_id']).first()
+    return (course is not None and course.id == course_id and
+            User.is_lti_instructor(session.get('roles', '')))
+
+
+@app.route('/export/<int:course_id>/<kind>.<format>', methods=['GET'])
+def export_course(course_id, kind, format):
+    '''
+    Download a course's submissions or logs; only for admins and the
+    course's instructors, whether logged in or launched from the LMS.
+    '''
+    if not (can_export(g.user, course_id) or lti_can_export(course_id)):
+        abort(403)
+    try:
+        chunks = export_chunks(course_id, kind, format)
+    except ValueError:
+        abort(404)
+    filename = 'course-{}-{}.{}'.format(course_id, kind, format)
+    return Response(stream_with_context(chunks), mimetype=FORMATS[format],
+                    headers={'Content-Disposition': 'attachment; filename=' + filename})
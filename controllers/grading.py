@@ -0,0 +1,234 @@
+'''
+Background delivery of LTI grades to the LMS outcome service.
+
+Posting a grade is a signed round-trip to the LMS, so rather than making the
+student's request wait on it, endpoints `submit` a GradeJob to the
+`grade_dispatcher`. A small pool of worker threads posts the jobs, retrying
+failures with exponential backoff. Jobs for the same (lis_result_sourcedid,
+submission) that have not been posted yet are collapsed to the latest one,
+since only the latest score matters to the LMS.
+
+For offline testing and benchmarking, setting GRADE_OUTCOME_STUB in the config
+registers a stand-in outcome service at /outcome_stub/ that accepts every
+replaceResult request.
+'''
+
+import time
+import heapq
+import atexit
+import logging
+import threading
+from uuid import uuid4
+from xml.sax.saxutils import escape
+
+from flask import Blueprint, Response, session
+
+from main import app
+
+logger = logging.getLogger('SystemLogger')
+
+REPLACE_RESULT_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<imsx_POXEnvelopeRequest xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">'
+    '<imsx_POXHeader><imsx_POXRequestHeaderInfo>'
+    '<imsx_version>V1.0</imsx_version>'
+    '<imsx_messageIdentifier>{message_id}</imsx_messageIdentifier>'
+    '</imsx_POXRequestHeaderInfo></imsx_POXHeader>'
+    '<imsx_POXBody><replaceResultRequest><resultRecord>'
+    '<sourcedGUID><sourcedId>{sourcedid}</sourcedId></sourcedGUID>'
+    '<result><resultScore><language>en</language>'
+    '<textString>{score}</textString></resultScore>'
+    '<resultData><text>{message}</text></resultData>'
+    '</result></resultRecord></replaceResultRequest></imsx_POXBody>'
+    '</imsx_POXEnvelopeRequest>')
+
+
+class GradeJob(object):
+    '''
+    Everything needed to post one grade, captured while the request (and
+    therefore the LTI session) is still available.
+    '''
+    def __init__(self, consumer_key, outcome_url, lis_result_sourcedid,
+                 submission_id, score, message):
+        self.consumer_key = consumer_key
+        self.outcome_url = outcome_url
+        self.lis_result_sourcedid = lis_result_sourcedid
+        self.submission_id = submission_id
+        self.score = score
+        self.message = message
+        self.attempts = 0
+
+    @staticmethod
+    def from_session(lis_result_sourcedid, submission_id, score, message):
+        return GradeJob(session['oauth_consumer_key'],
+                        session['lis_outcome_service_url'],
+                        lis_result_sourcedid, submission_id, score, message)
+
+    @property
+    def key(self):
+        return (self.lis_result_sourcedid, self.submission_id)
+
+    def to_xml(self):
+        return REPLACE_RESULT_XML.format(message_id=uuid4().hex,
+                                         sourcedid=escape(self.lis_result_sourcedid),
+                                         score=float(self.score),
+                                         message=escape(self.message))
+
+
+def post_grade_job(job):
+    '''
+    Sign and send the job to its outcome service; True if the LMS accepted it.
+    '''
+    from pylti.common import post_message
+    consumers = app.config['PYLTI_CONFIG']['consumers']
+    return post_message(consumers, job.consumer_key, job.outcome_url, job.to_xml())
+
+
+class GradeDispatcher(object):
+    def __init__(self, post=post_grade_job, workers=4, max_attempts=6,
+                 base_delay=1.0, max_delay=300.0):
+        self.post = post
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.submitted = 0
+        self.collapsed = 0
+        self.posted = 0
+        self.retried = 0
+        self.failed = 0
+        self._pending = {}
+        self._schedule = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        atexit.register(self.stop)
+
+    def stats(self):
+        return {'submitted': self.submitted, 'collapsed': self.collapsed,
+                'posted': self.posted, 'retried': self.retried,
+                'failed': self.failed, 'pending': len(self._pending)}
+
+    def submit(self, job):
+        with self._condition:
+            self.submitted += 1
+            if job.key in self._pending:
+                self.collapsed += 1
+                self._pending[job.key] = job
+            else:
+                self._pending[job.key] = job
+                self._schedule_key(job.key, time.time())
+            self._ensure_started()
+        return job
+
+    def _schedule_key(self, key, when):
+        self._sequence += 1
+        heapq.heappush(self._schedule, (when, self._sequence, key))
+        self._condition.notify()
+
+    def _ensure_started(self):
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, name='GradeDispatcher')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._stopping and not self._pending:
+                    return None
+                if self._schedule:
+                    when, _, key = self._schedule[0]
+                    delay = when - time.time()
+                    if delay <= 0 or self._stopping:
+                        heapq.heappop(self._schedule)
+                        job = self._pending.pop(key, None)
+                        if job is not None:
+                            return job
+                        continue
+                    self._condition.wait(delay)
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                accepted = self.post(job)
+            except Exception:
+                logger.exception("Grade post for {} raised".format(job.lis_result_sourcedid))
+                accepted = False
+            if accepted:
+                self.posted += 1
+            else:
+                self._retry(job)
+
+    def _retry(self, job):
+        job.attempts += 1
+        with self._condition:
+            if job.key in self._pending:
+                # A newer score arrived while this one was in flight
+                return
+            if job.attempts >= self.max_attempts or self._stopping:
+                self.failed += 1
+                logger.warning("Giving up on grade for {} after {} attempts".format(
+                               job.lis_result_sourcedid, job.attempts))
+                return
+            self.retried += 1
+            delay = min(self.base_delay * 2 ** (job.attempts - 1), self.max_delay)
+            self._pending[job.key] = job
+            self._schedule_key(job.key, time.time() + delay)
+
+    def stop(self, timeout=10):
+        '''
+        Post everything still pending (once, without further retries) and wait
+        for the workers to finish.
+        '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        deadline = time.time() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+        self._threads = []
+        with self._condition:
+            self._stopping = False
+
+
+grade_dispatcher = GradeDispatcher(workers=app.config.get('GRADE_DISPATCH_WORKERS', 4),
+                                   max_attempts=app.config.get('GRADE_DISPATCH_MAX_ATTEMPTS', 6),
+                                   base_delay=app.config.get('GRADE_DISPATCH_BASE_DELAY', 1.0))
+
+outcome_stub = Blueprint('outcome_stub', __name__, url_prefix='/outcome_stub')
+
+STUB_RESPONSE_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">'
+    '<imsx_POXHeader><imsx_POXResponseHeaderInfo>'
+    '<imsx_version>V1.0</imsx_version>'
+    '<imsx_messageIdentifier>{message_id}</imsx_messageIdentifier>'
+    '<imsx_statusInfo><imsx_codeMajor>success</imsx_codeMajor>'
+    '<imsx_severity>status</imsx_severity>'
+    '<imsx_description>Score recorded</imsx_description>'
+    '<imsx_operationRefIdentifier>replaceResult</imsx_operationRefIdentifier>'
+    '</imsx_statusInfo></imsx_POXResponseHeaderInfo></imsx_POXHeader>'
+    '<imsx_POXBody><replaceResultResponse/></imsx_POXBody>'
+    '</imsx_POXEnvelopeResponse>')
+
+@outcome_stub.route('/', methods=['POST'])
+def stub_outcome_service():
+    '''
+    Accepts any replaceResult request, after an optional artificial delay
+    (GRADE_OUTCOME_STUB_DELAY seconds) to imitate a slow LMS.
+    '''
+    time.sleep(app.config.get('GRADE_OUTCOME_STUB_DELAY', 0))
+    return Response(STUB_RESPONSE_XML.format(message_id=uuid4().hex),
+                    mimetype='application/xml')
+
+if app.config.get('GRADE_OUTCOME_STUB', False):
+    app.register_blueprint(outcome_stub)
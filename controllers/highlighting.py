@@ -0,0 +1,58 @@
+'''
+Pygments highlighting of student code for grade feedback.
+
+Students frequently re-run unchanged code, so the rendered HTML is memoized by
+a hash of the code in a cache bounded by its total size in (UTF-8) bytes. The
+lexer and formatter are built once and shared, and very large submissions are
+truncated before lexing so that one huge file cannot monopolize a worker.
+Pygments itself is only imported when the first feedback is highlighted,
+which keeps it out of worker start-up.
+'''
+
+import hashlib
+
+from main import app
+from models.cache import TTLCache, utf8_size
+
+HIGHLIGHT_MAX_LENGTH = app.config.get('HIGHLIGHT_MAX_LENGTH', 20000)
+TRUNCATION_NOTICE = "\n# ... (truncated, {} more characters)"
+
+_pygments = None
+
+def _load_pygments():
+    '''
+    Pygments' highlight function, with the shared lexer and formatter.
+    '''
+    global _pygments
+    if _pygments is None:
+        from pygments import highlight
+        from pygments.lexers import PythonLexer
+        from pygments.formatters import HtmlFormatter
+        _pygments = (highlight, PythonLexer(), HtmlFormatter())
+    return _pygments
+
+highlight_cache = TTLCache(max_entries=app.config.get('HIGHLIGHT_CACHE_ENTRIES', 4096),
+                           ttl=None,
+                           max_size=app.config.get('HIGHLIGHT_CACHE_SIZE', 8 * 1024 * 1024),
+                           sizeof=utf8_size)
+
+def _code_key(code):
+    if not isinstance(code, bytes):
+        code = code.encode('utf-8')
+    return hashlib.sha1(code).hexdigest()
+
+def highlight_python(code):
+    '''
+    Returns `code` as highlighted HTML, reusing earlier results for the same
+    code whenever possible.
+    '''
+    code = code or ''
+    key = _code_key(code)
+    html = highlight_cache.get(key)
+    if html is None:
+        if len(code) > HIGHLIGHT_MAX_LENGTH:
+            code = (code[:HIGHLIGHT_MAX_LENGTH] +
+                    TRUNCATION_NOTICE.format(len(code) - HIGHLIGHT_MAX_LENGTH))
+        highlight, lexer, formatter = _load_pygments()
+        html = highlight_cache.set(key, highlight(code, lexer, formatter))
+    return html
@@ -0,0 +1,136 @@
+'''
+Stopping the application cleanly.
+
+`drain` wraps the WSGI application and counts the requests in flight. Once
+`begin_drain` has been called, new requests are turned away with a 503 and a
+Retry-After, so a load balancer sends them to another server, while the ones
+already running finish. `shutdown` then waits for them and writes out what the
+background workers are still holding: buffered student code, queued log rows,
+grade posts, this process's request metrics and any unwritten log records.
+
+serve.py calls these on SIGTERM (and SIGINT); `request_shutdown` sends that
+signal to the serving process, for the /admin/shutdown route.
+'''
+
+import os
+import time
+import signal
+import logging
+import threading
+
+from werkzeug.wsgi import ClosingIterator
+
+from main import app, log_listener
+from models.models import db, log_sink, code_buffer
+from controllers.grading import grade_dispatcher
+from controllers.utility import request_metrics
+
+logger = logging.getLogger('SystemLogger')
+
+# The pid that serve.py runs the server in (the gunicorn master, in the
+# process mode); None under any other server
+server_pid = None
+
+
+class Drain(object):
+    def __init__(self, wsgi_app, retry_after=5):
+        self.wsgi_app = wsgi_app
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.draining = False
+        self._condition = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._condition:
+            if self.draining:
+                start_response('503 Service Unavailable',
+                               [('Content-Type', 'text/plain'), ('Connection', 'close'),
+                                ('Retry-After', str(self.retry_after))])
+                return [b'Shutting down\n']
+            self.in_flight += 1
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self._finished()
+            raise
+        # Streamed responses are only finished once they have been sent
+        return ClosingIterator(response, [self._finished])
+
+    def _finished(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def begin(self):
+        with self._condition:
+            self.draining = True
+
+    def wait(self, timeout):
+        '''
+        Wait up to `timeout` seconds for the requests in flight; returns how
+        many are still running.
+        '''
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.in_flight and time.time() < deadline:
+                self._condition.wait(deadline - time.time())
+            return self.in_flight
+
+
+drain = Drain(app.wsgi_app, retry_after=app.config.get('SERVE_RETRY_AFTER', 5))
+app.wsgi_app = drain
+
+
+def begin_drain():
+    drain.begin()
+
+
+def flush_background_work(timeout=10):
+    '''
+    Write out everything the background workers hold; logging goes last, so
+    that what the others log on the way out is kept.
+    '''
+    for name, step in (('code buffer', code_buffer.flush),
+                       ('log sink', log_sink.stop),
+                       ('grade dispatcher', lambda: grade_dispatcher.stop(timeout)),
+                       ('request metrics', request_metrics.flush)):
+        try:
+            step()
+        except Exception:
+            logger.exception("Could not flush the {}".format(name))
+    if log_listener is not None:
+        log_listener.stop(timeout)
+
+
+def shutdown(timeout=30):
+    '''
+    Stop taking requests, give those in flight up to `timeout` seconds, and
+    flush the background work. Safe to call more than once.
+    '''
+    begin_drain()
+    remaining = drain.wait(timeout)
+    if remaining:
+        logger.warning("Shutting down with {} requests still running".format(remaining))
+    flush_background_work()
+
+
+def after_fork():
+    '''
+    For each newly forked worker: connections opened by the parent must not
+    be shared, so every engine starts a fresh pool, and the request metrics
+    start over in a file of this process's own.
+    '''
+    db.engine.dispose()
+    for bind in app.config.get('SQLALCHEMY_BINDS') or {}:
+        db.get_engine(app, bind=bind).dispose()
+    request_metrics.after_fork()
+
+
+def request_shutdown():
+    '''
+    Ask the serving process to drain and stop; False if there is none.
+    '''
+    if server_pid is None:
+        return False
+    os.kill(server_pid, signal.SIGTERM)
+    return True
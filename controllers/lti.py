@@ -1,5 +1,6 @@
 from pprint import pprint
-from lxml import etree
+import json
+from datetime import datetime
 from urllib import quote as url_quote
 from urllib import urlencode
 from HTMLParser import HTMLParser
@@ -19,9 +20,7 @@ def strip_tags(html):
     return s.get_data()
 
 # Pygments, for reporting nicely formatted Python snippets
-from pygments import highlight
-from pygments.lexers import PythonLexer
-from pygments.formatters import HtmlFormatter
+from controllers.highlighting import highlight_python
 
 from flask.ext.wtf import Form
 from wtforms import IntegerField, BooleanField
@@ -38,15 +37,21 @@ from werkzeug.utils import secure_filename
 from sqlalchemy import Date, cast, func, desc, or_
 
 from controllers.helpers import instructor_required
+from controllers.grading import grade_dispatcher, GradeJob
+from controllers.conditional import make_etag, not_modified, with_validators
 
 from main import app
 from interaction_logger import StructuredEvent
 from models.models import (User, Course, 
                            Assignment, AssignmentGroup, AssignmentGroupMembership,
-                           Submission, Log)
+                           Submission, Log, assignment_pickers, after_commit)
+from models.cache import TTLCache
+from models.engine import replica_reads
 
 lti_assignments = Blueprint('lti_assignments', __name__, url_prefix='/lti_assignments')
 
+config_xml_cache = TTLCache(max_entries=16, ttl=None)
+
 def error(exception=None):
     """ render error page
 
@@ -66,8 +71,16 @@ def error(exception=None):
 def config():
     """ Create a new assignment with the given information
     """
-    return Response(render_template('lti/config.xml',
-                                    version='1'), mimetype='text/xml')
+    # Rendered once per host, since it only changes with a deploy
+    cached = config_xml_cache.get(request.host_url)
+    if cached is None:
+        xml = render_template('lti/config.xml', version='1')
+        cached = config_xml_cache.set(request.host_url, (xml, make_etag('config', xml)))
+    xml, etag = cached
+    unchanged = not_modified(etag)
+    if unchanged is not None:
+        return unchanged
+    return with_validators(Response(xml, mimetype='text/xml'), etag)
                                     
 def log_user_ip(uid):
     user_id = str(request.remote_addr)
@@ -98,7 +111,7 @@ def index(lti=lti):
     if assignment_group_id is not None:
         group = AssignmentGroup.by_id(assignment_group_id)
         assignments = group.get_assignments()
-        submissions = [a.get_submission(user.id) for a in assignments]
+        submissions = Submission.load_many(user.id, assignments)
     elif assignment_id is not None:
         assignments = [Assignment.by_id(assignment_id)]
         submissions = [assignments[0].get_submission(user.id)]
@@ -133,49 +146,159 @@ def ensure_canvas_arguments():
     '''
     Translates the current session data into a valid user
     '''
-    user = User.from_lti("canvas", 
-                         session["pylti_user_id"], 
-                         session.get("lis_person_contact_email_primary", ""),
-                         session.get("lis_person_name_given", "Canvas"),
-                         session.get("lis_person_name_family", "User"))
-    if "roles" in session:
-        roles = session["roles"].split(",")
-    else:
-        roles = []
-    course = Course.from_lti("canvas", 
-                             session["context_id"], 
-                             session.get("context_title", ""), 
-                             user.id)
-    return user, roles, course
+    user_id, course_id = ensure_canvas_ids()
+    roles = lti_role_mask()
+    return User.by_id(user_id), roles, Course.by_id(course_id)
+    
+def lti_user_id():
+    '''
+    The LTI user id of the current session: PyLTI as released on PyPI keeps
+    it as user_id, the fork this was written against as pylti_user_id.
+    '''
+    if "pylti_user_id" in session:
+        return session["pylti_user_id"]
+    return session["user_id"]
+    
+def lti_role_mask():
+    '''
+    Returns the bitmask of the current user's LTI roles (see
+    `User.lti_role_mask`), which is parsed once per launch and then kept in
+    the session.
+    '''
+    launching = request.form.get("lti_message_type") == "basic-lti-launch-request"
+    if launching or "lti_role_mask" not in session:
+        session["lti_role_mask"] = User.lti_role_mask(session.get("roles", ""))
+    return session["lti_role_mask"]
+    
+def ensure_canvas_ids():
+    '''
+    Translates the current session data into a user id and course id, without
+    touching the database once this process has resolved them before.
+    '''
+    user_id = User.id_from_lti("canvas", 
+                               lti_user_id(), 
+                               session.get("lis_person_contact_email_primary", ""),
+                               session.get("lis_person_name_given", "Canvas"),
+                               session.get("lis_person_name_family", "User"))
+    course_id = Course.id_from_lti("canvas", 
+                                   session["context_id"], 
+                                   session.get("context_title", ""), 
+                                   user_id)
+    return user_id, course_id
+    
+def render_assignment_picker(course_id, menu):
+    '''
+    The select.html page for a course. Rendered pages are cached per course,
+    menu and return url (the only inputs the template gets), and dropped
+    whenever the course's assignments or groups change.
+    '''
+    return_url = session['launch_presentation_return_url']
+    key = (course_id, menu, return_url)
+    page = assignment_pickers.get(key)
+    if page is None:
+        assignments, groups, strays = AssignmentGroup.course_tree(course_id)
+        page = assignment_pickers.set(key, render_template('lti/select.html',
+                                                           assignments=assignments,
+                                                           strays=strays, groups=groups,
+                                                           return_url=return_url,
+                                                           menu=menu))
+    return page
     
 @lti_assignments.route('/select/', methods=['GET', 'POST'])
 @lti_assignments.route('/select', methods=['GET', 'POST'])
 @lti(request='initial', error=error, role='staff', app=app)
+@replica_reads
 def select(lti=lti):
     """ Let's the user select from a list of assignments.
     """
     # Store current user_id and context_id
     user, roles, course = ensure_canvas_arguments()
-    assignments = Assignment.by_course(course.id, exclude_builtins=True)
-    groups = [(group, group.get_assignments())
-              for group in AssignmentGroup.by_course(course.id)]
-    strays = AssignmentGroup.get_ungrouped_assignments(course.id)
-    return_url = session['launch_presentation_return_url']
+    return render_assignment_picker(course.id, 'select')
     
-    return render_template('lti/select.html', assignments=assignments, strays=strays, groups=groups, return_url=return_url, menu='select')
+# check_assignments lists DEFAULT_PAGE_SIZE summaries unless given a
+# `limit`, and never more than MAX_PAGE_SIZE; batch_edit pages by MAX_PAGE_SIZE
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT) if timestamp is not None else None
+    
+def parse_timestamp(text):
+    if not text:
+        return None
+    if '.' not in text:
+        text += '.0'
+    return datetime.strptime(text, TIMESTAMP_FORMAT)
+    
+def encode_cursor(after):
+    '''
+    The `after` of an Assignment.summaries page, as an opaque string: the last
+    id, or with `since`, the last date_modified and id.
+    '''
+    if after is None:
+        return None
+    if isinstance(after, tuple):
+        return '{}~{}'.format(format_timestamp(after[0]), after[1])
+    return str(after)
+    
+def decode_cursor(cursor, with_since):
+    if not cursor:
+        return None
+    if with_since:
+        modified, last_id = cursor.split('~')
+        return parse_timestamp(modified), int(last_id)
+    return int(cursor)
+    
+def summary_to_dict(row):
+    summary = dict(zip(Assignment.SUMMARY_COLUMNS, row))
+    summary['title'] = row.name if row.name != "Untitled" else "Untitled ({})".format(row.id)
+    summary['date_modified'] = format_timestamp(row.date_modified)
+    return summary
     
 @lti_assignments.route('/check_assignments/', methods=['GET', 'POST'])
 @lti_assignments.route('/check_assignments', methods=['GET', 'POST'])
 @lti(request='session', app=app)
+@replica_reads
 def check_assignments(lti=lti):
     """ An AJAX endpoint for listing any new assignments.
     
+    Responds with `success` and `assignments`, as before, plus `cursor` (for
+    the next page; null on the last one) and `latest` (the `since` for a
+    later listing).
+    
+    This used to return every assignment in the course at once, with all of
+    its columns. Now each one is a summary, the SUMMARY_COLUMNS and `title`
+    without the body, code or answer, and a response holds at most `limit`
+    of them (DEFAULT_PAGE_SIZE unless given, never over MAX_PAGE_SIZE); keep
+    passing back `cursor` until it is null to list them all.
+    
+    Passing the `latest` of an earlier listing as `since` lists only the
+    assignments changed since then, and again any changed within the same
+    second as it, so de-duplicate by id.
+    
     Unused.
     """
     # Store current user_id and context_id
     user, roles, course = ensure_canvas_arguments()
-    assignments = Assignment.by_course(course.id)
-    return jsonify(success=True, assignments=[a.to_dict() for a in assignments])
+    try:
+        since = parse_timestamp(request.values.get('since'))
+        after = decode_cursor(request.values.get('cursor'), since is not None)
+        limit = min(max(int(request.values.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify(success=False, message="Invalid since, cursor or limit")
+    etag = make_etag('course_assignments', course.id, since, after, limit,
+                     *Assignment.course_validators(course.id))
+    unchanged = not_modified(etag)
+    if unchanged is not None:
+        return unchanged
+    rows, next_after = Assignment.summaries(course.id, since=since, after=after, limit=limit)
+    latest = max([row.date_modified for row in rows]) if rows else since
+    return with_validators(jsonify(success=True,
+                                   assignments=[summary_to_dict(row) for row in rows],
+                                   cursor=encode_cursor(next_after),
+                                   latest=format_timestamp(latest)),
+                           etag)
     
 @lti_assignments.route('/save_code/', methods=['GET', 'POST'])
 @lti_assignments.route('/save_code', methods=['GET', 'POST'])
@@ -187,21 +310,35 @@ def save_code(lti=lti):
         return jsonify(success=False, message="No Assignment ID given!")
     code = request.form.get('code', '')
     filename = request.form.get('filename', '__main__')
-    user = User.from_lti("canvas", session["pylti_user_id"], 
-                         session.get("user_email", ""),
-                         session.get("lis_person_name_given", ""),
-                         session.get("lis_person_name_family", ""))
+    user_id = User.id_from_lti("canvas", lti_user_id(), 
+                               session.get("user_email", ""),
+                               session.get("lis_person_name_given", ""),
+                               session.get("lis_person_name_family", ""))
     is_version_correct = True
+    submission_version = None
     if filename == "__main__":
-        submission, is_version_correct = Submission.save_code(user.id, assignment_id, code, assignment_version)
-    elif User.is_lti_instructor(session["roles"]):
+        patch = request.form.get('patch', None)
+        if patch is None:
+            submission_version, is_version_correct = Submission.save_code(user_id, assignment_id, code, assignment_version)
+        else:
+            try:
+                base_version = int(request.form.get('base_version', -1))
+                submission_version, is_version_correct = Submission.patch_code(user_id, assignment_id, base_version, json.loads(patch), assignment_version)
+            except (ValueError, TypeError):
+                return jsonify(success=False, full_code_required=True,
+                               message="The patch could not be applied.")
+            if submission_version is None:
+                return jsonify(success=False, full_code_required=True,
+                               message="The code has changed since that version.")
+    elif User.is_lti_instructor(lti_role_mask()):
         if filename == "on_run":
             Assignment.edit(assignment_id=assignment_id, on_run=code)
         elif filename == "on_change":
             Assignment.edit(assignment_id=assignment_id, on_step=code)
         elif filename == "starting_code":
             Assignment.edit(assignment_id=assignment_id, on_start=code)
-    return jsonify(success=True, is_version_correct=is_version_correct)
+    return jsonify(success=True, is_version_correct=is_version_correct,
+                   submission_version=submission_version)
     
 @lti_assignments.route('/save_events/', methods=['GET', 'POST'])
 @lti_assignments.route('/save_events', methods=['GET', 'POST'])
@@ -212,11 +349,12 @@ def save_events(lti=lti):
     action = request.form.get('action', "missing")
     if assignment_id is None:
         return jsonify(success=False, message="No Assignment ID given!")
-    user = User.from_lti("canvas", session["pylti_user_id"], 
-                         session.get("user_email", ""),
-                         session.get("lis_person_name_given", ""),
-                         session.get("lis_person_name_family", ""))
-    log = Log.new(event, action, assignment_id, user.id)
+    user_id = User.id_from_lti("canvas", lti_user_id(), 
+                               session.get("user_email", ""),
+                               session.get("lis_person_name_given", ""),
+                               session.get("lis_person_name_family", ""))
+    if not Log.queue(event, action, assignment_id, user_id):
+        return jsonify(success=False, message="Server is busy, event was not recorded.")
     return jsonify(success=True)
     
 @lti_assignments.route('/save_correct/', methods=['GET', 'POST'])
@@ -228,15 +366,15 @@ def save_correct(lti=lti):
     lis_result_sourcedid = request.form.get('lis_result_sourcedid', None)
     if assignment_id is None:
         return jsonify(success=False, message="No Assignment ID given!")
-    user = User.from_lti("canvas", session["pylti_user_id"], 
-                         session.get("user_email", ""),
-                         session.get("lis_person_name_given", ""),
-                         session.get("lis_person_name_family", ""))
+    user_id = User.id_from_lti("canvas", lti_user_id(), 
+                               session.get("user_email", ""),
+                               session.get("lis_person_name_given", ""),
+                               session.get("lis_person_name_family", ""))
     assignment = Assignment.by_id(assignment_id)
     if status == 1:
-        submission = Submission.save_correct(user.id, assignment_id)
+        submission = Submission.save_correct(user_id, assignment_id)
     else:
-        submission = assignment.get_submission(user.id)
+        submission = assignment.get_submission(user_id)
     if submission.correct:
         message = "Success!"
     else:
@@ -245,24 +383,36 @@ def save_correct(lti=lti):
     if lis_result_sourcedid is None:
         return jsonify(success=False, message="Not in a grading context.")
     if assignment.mode == 'maze':
-        lti.post_grade(float(submission.correct), "<h1>{0}</h1>".format(message), endpoint=lis_result_sourcedid);
+        feedback = "<h1>{0}</h1>".format(message)
     else:
-        lti.post_grade(float(submission.correct), "<h1>{0}</h1>".format(message)+"<div>Latest work in progress: <a href='{0}' target='_blank'>View</a></div>".format(url)+"<div>Touches: {0}</div>".format(submission.version)+"Last ran code:<br>"+highlight(submission.code, PythonLexer(), HtmlFormatter()), endpoint=lis_result_sourcedid)
+        feedback = "<h1>{0}</h1>".format(message)+"<div>Latest work in progress: <a href='{0}' target='_blank'>View</a></div>".format(url)+"<div>Touches: {0}</div>".format(submission.version)+"Last ran code:<br>"+highlight_python(submission.code)
+    # Only post the grade once the submission it reports is committed
+    after_commit(grade_dispatcher.submit,
+                 GradeJob.from_session(lis_result_sourcedid, submission.id,
+                                       float(submission.correct), feedback))
     return jsonify(success=True)
     
 @lti_assignments.route('/get_submission_code/', methods=['GET', 'POST'])
 @lti_assignments.route('/get_submission_code', methods=['GET', 'POST'])
 @lti(request='session', app=app)
+@replica_reads
 def get_submission_code(lti=lti):
     user, roles, course = ensure_canvas_arguments()
     submission_id = request.values.get('submission_id', None)
     if submission_id is None:
         return "Sorry, no submission ID was given."
-    submission = Submission.query.get(submission_id)
-    if User.is_lti_instructor(session["roles"]) or submission.user_id == user.id:
-        return submission.code if submission.code else "#No code given!"
-    else:
+    validators = Submission.validators(submission_id)
+    if validators is None:
+        return "Sorry, that submission does not exist."
+    if not (User.is_lti_instructor(lti_role_mask()) or validators.user_id == user.id):
         return "Sorry, you do not have sufficient permissions to spy!"
+    etag = make_etag('submission_code', *validators)
+    unchanged = not_modified(etag, validators.date_modified)
+    if unchanged is not None:
+        return unchanged
+    submission = Submission.by_id(submission_id)
+    return with_validators(make_response(submission.code if submission.code else "#No code given!"),
+                           etag, validators.date_modified)
     
 @lti_assignments.route('/save_presentation/', methods=['GET', 'POST'])
 @lti_assignments.route('/save_presentation', methods=['GET', 'POST'])
@@ -275,16 +425,13 @@ def save_presentation(lti=lti):
     parsons = request.form.get('parsons', "false") == "true"
     text_first = request.form.get('text_first', "false") == "true"
     name = request.form.get('name', "")
-    if User.is_lti_instructor(session["roles"]):
+    if User.is_lti_instructor(lti_role_mask()):
         Assignment.edit(assignment_id=assignment_id, presentation=presentation, name=name, parsons=parsons, text_first=text_first)
         return jsonify(success=True)
     else:
         return jsonify(success=False, message="You are not an instructor!")
         
         
-import explain
-
-
 # refreshAssignment
     
 @lti_assignments.route('/assignment/new/', methods=['GET', 'POST'])
@@ -325,6 +472,7 @@ def remove_assignment(lti=lti):
 @lti_assignments.route('/assignment/get/', methods=['GET', 'POST'])
 @lti_assignments.route('/assignment/get', methods=['GET', 'POST'])
 @lti(request='session', app=app)
+@replica_reads
 def get_assignment(lti=lti):
     '''
     Returns metadata about the assignment.
@@ -336,8 +484,15 @@ def get_assignment(lti=lti):
     if not User.is_lti_instructor(roles):
         return jsonify(success=False, message="You are not an instructor in this course.")
     # TODO: Security hole, evil instructors could remove assignments outside of their course
+    validators = Assignment.validators(assignment_id)
+    if validators is None:
+        return jsonify(success=False, message="Assignment not found")
+    etag = make_etag('assignment', *validators)
+    unchanged = not_modified(etag, validators.date_modified)
+    if unchanged is not None:
+        return unchanged
     assignment = Assignment.by_id(assignment_id)
-    return jsonify(success=True, url=assignment.url, name=assignment.name,
+    return with_validators(jsonify(success=True, url=assignment.url, name=assignment.name,
                    body= strip_tags(assignment.body)[:255],
                    on_run=assignment.on_run,
                    title= assignment.title(),
@@ -345,9 +500,8 @@ def get_assignment(lti=lti):
                    visibility=assignment.visibility, disabled=assignment.disabled,
                    mode=assignment.mode, version=assignment.version,
                    id=assignment.id, course_id=assignment.course_id,
-                   date_modified = assignment.date_modified.strftime(" %I:%M%p on %a %d, %b %Y").replace(" 0", " "))
-
-import assignment_groups
+                   date_modified = assignment.date_modified.strftime(" %I:%M%p on %a %d, %b %Y").replace(" 0", " ")),
+                   etag, validators.date_modified)
     
 @lti_assignments.route('/select_builtin_assignment/', methods=['GET', 'POST'])
 @lti_assignments.route('/select_builtin_assignment', methods=['GET', 'POST'])
@@ -395,9 +549,24 @@ def batch_edit(lti=lti):
     user, roles, course = ensure_canvas_arguments()
     if not User.is_lti_instructor(roles):
         return "You are not an instructor in this course."
-    assignments = Assignment.by_course(course.id)
+    try:
+        after = decode_cursor(request.args.get('cursor'), False)
+    except ValueError:
+        return "Invalid cursor."
+    rows, next_after = Assignment.summaries(course.id, after=after, limit=MAX_PAGE_SIZE)
+    # Only MAX_PAGE_SIZE assignments are shown at a time, so link the pages
+    next_url = previous_url = None
+    if next_after is not None:
+        next_url = url_for('lti_assignments.batch_edit', cursor=encode_cursor(next_after))
+    if after is not None:
+        previous_after = Assignment.previous_summaries_after(course.id, after, limit=MAX_PAGE_SIZE)
+        previous_url = url_for('lti_assignments.batch_edit', cursor=encode_cursor(previous_after))
     return render_template('lti/batch.html', 
-                           assignments=assignments,
+                           assignments=[summary_to_dict(row) for row in rows],
+                           next_cursor=encode_cursor(next_after),
+                           next_url=next_url,
+                           previous_url=previous_url,
+                           page_size=MAX_PAGE_SIZE,
                            user_id=user.id,
                            context_id=course.id)
     
@@ -415,6 +584,7 @@ def dashboard(lti=lti):
 @lti_assignments.route('/share/', methods=['GET', 'POST'])
 @lti_assignments.route('/share', methods=['GET', 'POST'])
 @lti(request='initial', error=error, role='staff', app=app)
+@replica_reads
 def share(lti=lti):
     """ render the contents of the staff.html template
 
@@ -422,13 +592,7 @@ def share(lti=lti):
     :return: the staff.html template rendered
     """
     user, roles, course = ensure_canvas_arguments()
-    assignments = Assignment.by_course(course.id, exclude_builtins=True)
-    groups = [(group, group.get_assignments())
-              for group in AssignmentGroup.by_course(course.id)]
-    strays = AssignmentGroup.get_ungrouped_assignments(course.id)
-    return_url = session['launch_presentation_return_url']
-    
-    return render_template('lti/select.html', assignments=assignments, strays=strays, groups=groups, return_url=return_url, menu='share')
+    return render_assignment_picker(course.id, 'share')
 
 @lti_assignments.route('/shared/', methods=['GET', 'POST'])
 @lti_assignments.route('/shared', methods=['GET', 'POST'])
@@ -447,7 +611,7 @@ def shared(lti=lti):
     if assignment_group_id is not None:
         group = AssignmentGroup.by_id(assignment_group_id)
         assignments = group.get_assignments()
-        submissions = [a.get_submission(user.id) for a in assignments]
+        submissions = Submission.load_many(user.id, assignments)
     elif assignment_id is not None:
         assignments = [Assignment.by_id(assignment_id)]
         submissions = [assignments[0].get_submission(user.id)]
@@ -481,11 +645,16 @@ def grade(lti=lti):
     assignment_id = request.form.get('question_id', None)
     if assignment_id is None:
         return jsonify(success=False, message="No Assignment ID given!")
-    user = User.from_lti("canvas", session["pylti_user_id"], 
-                         session.get("user_email", ""))
-    submission = Submission.save_correct(user.id, assignment_id)
+    user_id = User.id_from_lti("canvas", lti_user_id(), 
+                               session.get("user_email", ""),
+                               session.get("lis_person_name_given", ""),
+                               session.get("lis_person_name_family", ""))
+    submission = Submission.save_correct(user_id, assignment_id)
     if 'lis_result_sourcedid' not in session:
         return "Failure"
     #session[''] = session['lis_outcome_service_url']
-    lti.post_grade(1, "<h1>Success</h1>"+highlight(submission.code, PythonLexer(), HtmlFormatter()))
+    # As in save_correct, only post the grade once the submission is committed
+    after_commit(grade_dispatcher.submit,
+                 GradeJob.from_session(session['lis_result_sourcedid'], submission.id, 1,
+                                       "<h1>Success</h1>"+highlight_python(submission.code)))
     return "Successful!"
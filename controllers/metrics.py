@@ -0,0 +1,292 @@
+'''
+Request metrics, shared between worker processes.
+
+On the request thread, starting a request only advances a count and finishing
+one only appends its (endpoint, seconds, error, queries, database seconds) to
+a deque; neither takes a
+lock or checks for a fork, since `after_fork` resets them in each new worker.
+Every METRICS_FLUSH_INTERVAL seconds a background thread adds those up into
+this process's counts (per endpoint: requests, errors, and histograms of the
+latency, the number of SQL statements and the time spent in the database;
+see controllers/profiling.py) and copies them into `METRICS_DIR/metrics-<pid>.db`, a
+memory-mapped file, along with gauges for in-flight requests, the database
+pool and the background queues. `/metrics` reads every process's file and adds
+them up, so any worker can answer for all of them.
+
+Each file begins with its own list of endpoint names, so processes only need
+to agree on names, not on slot positions. Counters from processes that have
+exited are still counted; their gauges are not.
+'''
+
+import os
+import json
+import errno
+import glob
+import mmap
+import time
+import struct
+import atexit
+import itertools
+import collections
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger('SystemLogger')
+
+# Upper bounds of the histogram buckets; the last bucket is unbounded
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+DB_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Per endpoint: requests, errors, total seconds, total statements, total
+# database seconds, then each histogram's buckets
+REQUESTS, ERRORS, SECONDS, QUERIES, DB_SECONDS = 0, 1, 2, 3, 4
+FIRST_BUCKET = 5
+FIRST_QUERY_BUCKET = FIRST_BUCKET + len(LATENCY_BUCKETS) + 1
+FIRST_DB_BUCKET = FIRST_QUERY_BUCKET + len(QUERY_COUNT_BUCKETS) + 1
+SLOT_WIDTH = FIRST_DB_BUCKET + len(DB_TIME_BUCKETS) + 1
+GAUGES = ('in_flight', 'db_pool_size', 'db_pool_checked_out', 'db_pool_overflow',
+          'log_sink_pending', 'grade_dispatcher_pending', 'code_buffer_pending')
+OTHER_ENDPOINT = '<other>'
+HEADER = struct.Struct('<II')
+
+
+class RequestMetrics(object):
+    def __init__(self, directory, endpoints, gauge_sources=(), flush_interval=1.0):
+        '''
+        `endpoints` is called (once, at the first request) for the names to
+        give slots to; `gauge_sources` are functions returning a dictionary of
+        some of the GAUGES.
+        '''
+        self.directory = directory
+        self.endpoints = endpoints
+        self.gauge_sources = gauge_sources
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._map = None
+        self._data_offset = 0
+        self._reset()
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._slots = None
+        self._values = None
+        self._finished = collections.deque()
+        self._finished_count = 0
+        # Counting a start is just advancing a count, which is atomic; the
+        # flushing thread reads it by advancing it too, and takes its own
+        # reads back off
+        self._start_count = itertools.count()
+        self._start_reads = 0
+        self.start_request = self._start_count.next
+
+    def open(self):
+        '''
+        Lay out this process's slots, create its file and start flushing to
+        it; the application calls this before its first request.
+        '''
+        with self._lock:
+            if self._map is None:
+                self._open()
+
+    def after_fork(self):
+        '''
+        In a newly forked worker: discard the parent's numbers and, if the
+        parent had opened its file, open one of this process's own.
+        '''
+        # The flushing thread was not forked, but may have held the lock
+        self._lock = threading.Lock()
+        reopen = self._map is not None
+        self._map = self._pid = None
+        self._reset()
+        if reopen:
+            self._open()
+
+    def _open(self):
+        '''
+        Lay out this process's slots and create its file.
+        '''
+        names = sorted(set(self.endpoints())) + [OTHER_ENDPOINT]
+        self._slots = dict((name, index * SLOT_WIDTH) for index, name in enumerate(names))
+        self._values = [0.0] * (len(names) * SLOT_WIDTH)
+        header = json.dumps({'endpoints': names, 'buckets': LATENCY_BUCKETS,
+                             'query_buckets': QUERY_COUNT_BUCKETS,
+                             'db_time_buckets': DB_TIME_BUCKETS,
+                             'gauges': GAUGES}).encode('utf-8')
+        self._data_offset = HEADER.size + len(header)
+        self._data_offset += -self._data_offset % 8
+        size = self._data_offset + 8 * (len(self._values) + len(GAUGES))
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, 'metrics-{}.db'.format(os.getpid()))
+        with open(path, 'w+b') as metrics_file:
+            metrics_file.truncate(size)
+            self._map = mmap.mmap(metrics_file.fileno(), size)
+        HEADER.pack_into(self._map, 0, len(header), len(self._values))
+        self._map[HEADER.size:HEADER.size + len(header)] = header
+        self._pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='RequestMetrics')
+        thread.daemon = True
+        thread.start()
+
+    def finish_request(self, endpoint, seconds, error, queries=0, db_seconds=0.0):
+        # Only queued here; the flushing thread does the arithmetic
+        self._finished.append((endpoint, seconds, error, queries, db_seconds))
+
+    def _tally(self):
+        values, slots = self._values, self._slots
+        other = slots[OTHER_ENDPOINT]
+        while True:
+            try:
+                endpoint, seconds, error, queries, db_seconds = self._finished.popleft()
+            except IndexError:
+                return
+            base = slots.get(endpoint, other)
+            values[base + REQUESTS] += 1
+            values[base + SECONDS] += seconds
+            values[base + QUERIES] += queries
+            values[base + DB_SECONDS] += db_seconds
+            values[base + FIRST_BUCKET + bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            values[base + FIRST_QUERY_BUCKET + bisect.bisect_left(QUERY_COUNT_BUCKETS, queries)] += 1
+            values[base + FIRST_DB_BUCKET + bisect.bisect_left(DB_TIME_BUCKETS, db_seconds)] += 1
+            if error:
+                values[base + ERRORS] += 1
+            self._finished_count += 1
+
+    def _gauges(self):
+        gauges = dict.fromkeys(GAUGES, 0)
+        self._start_reads += 1
+        started = self._start_count.next() - self._start_reads + 1
+        gauges['in_flight'] = started - self._finished_count
+        for source in self.gauge_sources:
+            try:
+                gauges.update(source())
+            except Exception:
+                logger.exception("Could not read gauges from {}".format(source))
+        return [float(gauges[name]) for name in GAUGES]
+
+    def flush(self):
+        if self._map is None or self._pid != os.getpid():
+            return
+        with self._lock:
+            self._tally()
+            values = self._values + self._gauges()
+            struct.pack_into('<{}d'.format(len(values)), self._map, self._data_offset, *values)
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        # It exists, but belongs to someone else
+        return e.errno == errno.EPERM
+    return True
+
+
+def remove_stale_metrics(directory):
+    '''
+    Delete the files of processes that are no longer running.
+    '''
+    for path in glob.glob(os.path.join(directory, 'metrics-*.db')):
+        try:
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.db')])
+        except ValueError:
+            continue
+        if not _is_running(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def read_metrics(directory):
+    '''
+    Add up every process's file: returns ({endpoint: [slot values]}, {gauge: value}).
+    '''
+    endpoints, gauges = {}, dict.fromkeys(GAUGES, 0.0)
+    for path in glob.glob(os.path.join(directory, 'metrics-*.db')):
+        try:
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.db')])
+            with open(path, 'rb') as metrics_file:
+                data = metrics_file.read()
+            header_length, value_count = HEADER.unpack_from(data, 0)
+            header = json.loads(data[HEADER.size:HEADER.size + header_length].decode('utf-8'))
+            offset = HEADER.size + header_length
+            offset += -offset % 8
+            file_gauges = header['gauges']
+            values = struct.unpack_from('<{}d'.format(value_count + len(file_gauges)), data, offset)
+        except (ValueError, KeyError, struct.error):
+            # Another process is still creating it
+            continue
+        if (tuple(header['buckets']) != LATENCY_BUCKETS or
+                tuple(header.get('query_buckets', ())) != QUERY_COUNT_BUCKETS or
+                tuple(header.get('db_time_buckets', ())) != DB_TIME_BUCKETS):
+            continue
+        for index, name in enumerate(header['endpoints']):
+            slot = values[index * SLOT_WIDTH:(index + 1) * SLOT_WIDTH]
+            total = endpoints.setdefault(name, [0.0] * SLOT_WIDTH)
+            for position, value in enumerate(slot):
+                total[position] += value
+        if _is_running(pid):
+            for name, value in zip(file_gauges, values[value_count:]):
+                if name in gauges:
+                    gauges[name] += value
+    return endpoints, gauges
+
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(int(value)) if value == int(value) else repr(value)
+
+
+def prometheus_text(endpoints, gauges, prefix='app'):
+    '''
+    Render `read_metrics` results in the Prometheus text exposition format.
+    '''
+    lines = []
+    def family(name, kind, description):
+        lines.append('# HELP {}_{} {}'.format(prefix, name, description))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+    names = sorted(name for name, slot in endpoints.items() if slot[REQUESTS])
+
+    family('requests_total', 'counter', 'Requests handled, by endpoint.')
+    for name in names:
+        lines.append('{}_requests_total{{endpoint="{}"}} {}'.format(
+                     prefix, _label(name), _number(endpoints[name][REQUESTS])))
+    family('request_errors_total', 'counter', 'Requests that failed with an exception or a 5xx status.')
+    for name in names:
+        lines.append('{}_request_errors_total{{endpoint="{}"}} {}'.format(
+                     prefix, _label(name), _number(endpoints[name][ERRORS])))
+    def histogram(metric, description, bounds, first, total):
+        family(metric, 'histogram', description)
+        for name in names:
+            slot = endpoints[name]
+            cumulative = 0
+            for bound, count in zip(bounds + ('+Inf',), slot[first:first + len(bounds) + 1]):
+                cumulative += count
+                lines.append('{}_{}_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                             prefix, metric, _label(name), bound, _number(cumulative)))
+            lines.append('{}_{}_sum{{endpoint="{}"}} {}'.format(
+                         prefix, metric, _label(name), _number(slot[total])))
+            lines.append('{}_{}_count{{endpoint="{}"}} {}'.format(
+                         prefix, metric, _label(name), _number(slot[REQUESTS])))
+    histogram('request_duration_seconds', 'Time spent handling each request.',
+              LATENCY_BUCKETS, FIRST_BUCKET, SECONDS)
+    histogram('request_queries', 'SQL statements issued by each request.',
+              QUERY_COUNT_BUCKETS, FIRST_QUERY_BUCKET, QUERIES)
+    histogram('request_db_seconds', 'Time each request spent in the database.',
+              DB_TIME_BUCKETS, FIRST_DB_BUCKET, DB_SECONDS)
+    for name in GAUGES:
+        family(name, 'gauge', 'Sum over the running worker processes.')
+        lines.append('{}_{} {}'.format(prefix, name, _number(gauges[name])))
+    return '\n'.join(lines) + '\n'
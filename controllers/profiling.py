@@ -0,0 +1,149 @@
+'''
+Counts the SQL each request issues.
+
+Every statement executed while a request is active is timed through the
+SQLAlchemy engine events, and the request's totals (statements, time spent in
+the database, the slowest statement and the number of commits) are kept on
+`g.query_stats`. When the request finishes they are
+
+    * sent back as X-Query-* response headers, in debug mode;
+    * added to the per-endpoint request_queries and request_db_seconds
+      histograms that /metrics exports for every worker process (by
+      `finish_request_metrics`, in controllers/__init__.py);
+    * added to this process's own statistics, which `manage.py bench` reads
+      (see `endpoint_snapshot`);
+    * and any statement slower than SLOW_QUERY_THRESHOLD seconds is written
+      to the SlowQueries log (SLOW_QUERY_LOG_FILE).
+'''
+
+import time
+import bisect
+import logging
+import threading
+
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from main import app
+from controllers.metrics import QUERY_COUNT_BUCKETS, DB_TIME_BUCKETS
+
+logger = logging.getLogger('SlowQueries')
+
+SLOW_QUERY_THRESHOLD = app.config.get('SLOW_QUERY_THRESHOLD', 0.1)
+
+
+class QueryStats(object):
+    __slots__ = ('count', 'total_time', 'slowest_time', 'slowest_statement', 'commits')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+        self.commits = 0
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        if duration > self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+
+
+class EndpointStats(object):
+    def __init__(self):
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.db_time = Histogram(DB_TIME_BUCKETS)
+        self.commits = 0
+        self.slow_queries = 0
+
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def _current_stats():
+    if has_app_context():
+        return getattr(g, 'query_stats', None)
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start_times', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(connection, cursor, statement, parameters, context, executemany):
+    duration = time.time() - connection.info['query_start_times'].pop()
+    stats = _current_stats()
+    if stats is not None:
+        stats.record(statement, duration)
+    if duration >= SLOW_QUERY_THRESHOLD:
+        logger.warning("{:.0f} ms in {}: {}".format(
+                       duration * 1000, request.endpoint if stats is not None else 'background',
+                       ' '.join(statement.split())))
+
+
+@event.listens_for(Engine, 'commit')
+def _count_commit(connection):
+    stats = _current_stats()
+    if stats is not None:
+        stats.commits += 1
+
+
+def start_request():
+    g.query_stats = QueryStats()
+
+
+def finish_request(response):
+    stats = getattr(g, 'query_stats', None)
+    if stats is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    with _endpoints_lock:
+        endpoint_stats = _endpoints.get(endpoint)
+        if endpoint_stats is None:
+            endpoint_stats = _endpoints[endpoint] = EndpointStats()
+        endpoint_stats.queries.observe(stats.count)
+        endpoint_stats.db_time.observe(stats.total_time)
+        endpoint_stats.commits += stats.commits
+        if stats.slowest_time >= SLOW_QUERY_THRESHOLD:
+            endpoint_stats.slow_queries += 1
+    if app.debug:
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time-Ms'] = '{:.2f}'.format(stats.total_time * 1000)
+        response.headers['X-Query-Commits'] = str(stats.commits)
+        response.headers['X-Query-Slowest-Ms'] = '{:.2f}'.format(stats.slowest_time * 1000)
+    return response
+
+
+def endpoint_snapshot():
+    '''
+    A copy of the per-endpoint statistics, as plain dictionaries.
+    '''
+    with _endpoints_lock:
+        return {endpoint: {'requests': stats.queries.total,
+                           'queries': {'buckets': list(zip(stats.queries.bounds, stats.queries.counts)),
+                                       'overflow': stats.queries.counts[-1],
+                                       'sum': stats.queries.sum},
+                           'db_time': {'buckets': list(zip(stats.db_time.bounds, stats.db_time.counts)),
+                                       'overflow': stats.db_time.counts[-1],
+                                       'sum': stats.db_time.sum},
+                           'commits': stats.commits,
+                           'slow_queries': stats.slow_queries}
+                for endpoint, stats in _endpoints.items()}
@@ -0,0 +1,147 @@
+'''
+Server-side sessions.
+
+By default Flask serializes the entire session (including every LTI launch
+parameter that pylti stores there) into a signed cookie, which the browser
+then uploads, and the server re-verifies, on every AJAX call. With
+SESSION_BACKEND set to 'memory' or 'sqlite', the session data stays on the
+server instead and the cookie only carries a random session id.
+
+    memory: an LRU with expiry inside each process; only suitable when a
+            single process serves all requests (e.g., threaded workers).
+    sqlite: a SQLite file (SESSION_SQLITE_PATH) shared by all processes on
+            the machine.
+'''
+
+import os
+import time
+import sqlite3
+import pickle
+import binascii
+import threading
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from models.cache import TTLCache
+
+
+def _new_session_id():
+    return binascii.hexlify(os.urandom(24)).decode('ascii')
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class MemorySessionStore(object):
+    def __init__(self, max_entries=100000, lifetime=31 * 24 * 3600):
+        self.sessions = TTLCache(max_entries=max_entries, ttl=lifetime)
+
+    def load(self, sid):
+        return self.sessions.get(sid)
+
+    def save(self, sid, data, lifetime):
+        # Copy, so later changes to a live session are not visible until saved
+        self.sessions.set(sid, dict(data))
+
+    def delete(self, sid):
+        self.sessions.discard(sid)
+
+
+class SqliteSessionStore(object):
+    CLEANUP_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS session "
+                               "(sid TEXT PRIMARY KEY, data BLOB, expires REAL)")
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def load(self, sid):
+        row = self._connection().execute("SELECT data, expires FROM session WHERE sid = ?",
+                                         (sid,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def save(self, sid, data, lifetime):
+        blob = sqlite3.Binary(pickle.dumps(dict(data), pickle.HIGHEST_PROTOCOL))
+        with self._connection() as connection:
+            connection.execute("INSERT OR REPLACE INTO session (sid, data, expires) "
+                               "VALUES (?, ?, ?)", (sid, blob, time.time() + lifetime))
+            self._writes += 1
+            if self._writes % self.CLEANUP_EVERY == 0:
+                connection.execute("DELETE FROM session WHERE expires < ?", (time.time(),))
+
+    def delete(self, sid):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM session WHERE sid = ?", (sid,))
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            data = self.store.load(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=_new_session_id(), new=True)
+
+    def save_session(self, app, session, response):
+        cookie_name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(cookie_name, domain=domain, path=path)
+            return
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        if session.modified or session.new:
+            self.store.save(session.sid, session, lifetime)
+        if session.new or session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app))
+
+
+def install_session_interface(app):
+    '''
+    Swap in the server-side session store chosen by SESSION_BACKEND; the
+    default, 'cookie', leaves Flask's signed-cookie sessions in place.
+    '''
+    backend = app.config.get('SESSION_BACKEND', 'cookie')
+    if backend == 'memory':
+        store = MemorySessionStore(app.config.get('SESSION_MEMORY_MAX_ENTRIES', 100000),
+                                   app.permanent_session_lifetime.total_seconds())
+    elif backend == 'sqlite':
+        store = SqliteSessionStore(app.config['SESSION_SQLITE_PATH'])
+    elif backend == 'cookie':
+        return
+    else:
+        raise ValueError("Unknown SESSION_BACKEND: {}".format(backend))
+    app.session_interface = ServerSessionInterface(store)
@@ -1,11 +1,30 @@
 import os
 
 # Flask tools
-from flask import send_from_directory, url_for
+from flask import send_from_directory, url_for, Response
 
 # Application specific
 from main import app
-from models.models import db, User, Role
+from models.models import db, User, Role, log_sink, code_buffer
+from controllers.grading import grade_dispatcher
+from controllers.metrics import RequestMetrics, read_metrics, prometheus_text
+
+def pool_gauges():
+    pool = db.engine.pool
+    # Only some pools (e.g., QueuePool) keep these counts
+    return {'db_pool_size': pool.size() if hasattr(pool, 'size') else 0,
+            'db_pool_checked_out': pool.checkedout() if hasattr(pool, 'checkedout') else 0,
+            'db_pool_overflow': max(0, pool.overflow()) if hasattr(pool, 'overflow') else 0}
+
+def queue_gauges():
+    return {'log_sink_pending': log_sink.stats()['pending'],
+            'grade_dispatcher_pending': grade_dispatcher.stats()['pending'],
+            'code_buffer_pending': code_buffer.stats()['pending']}
+
+request_metrics = RequestMetrics(app.config['METRICS_DIR'],
+                                 endpoints=lambda: list(app.view_functions),
+                                 gauge_sources=(pool_gauges, queue_gauges),
+                                 flush_interval=app.config.get('METRICS_FLUSH_INTERVAL', 1.0))
 
 @app.route('/favicon.ico', methods=['GET', 'POST'])
 def favicon():
@@ -35,4 +54,14 @@ def site_map():
         line = urllib.unquote("<td>{:50s}</td><td>{:20s}</td><td>{}</td>".format(rule.endpoint, methods, url))
         output.append(line)
     return "<table><tr>{}</tr></table>".format("</tr><tr>".join(sorted(output)))
-        
\ No newline at end of file
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    '''
+    Request counts, latencies, errors and queue depths for every worker
+    process, in the Prometheus text format.
+    '''
+    request_metrics.flush()
+    endpoints, gauges = read_metrics(app.config['METRICS_DIR'])
+    return Response(prometheus_text(endpoints, gauges),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,313 @@
+'''
+Logging for the application, arranged so that request threads never format or
+write log records themselves.
+
+Loggers get a QueueHandler, which only puts the record on a queue. A single
+QueueListener thread takes records off the queue in batches and hands each
+batch to the real handlers: stdout for the SystemLogger, and for the
+ExternalInteractions logger a JSON-lines file, which is written with one
+write per batch and rotated by size and by age, and which every worker process
+can share.
+
+StructuredEvents (the things we record about students) are serialized as one
+compact JSON object per line.
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+
+class StructuredEvent(object):
+    '''
+    One interaction, e.g., a student's IP address being recorded at launch.
+    '''
+    __slots__ = ('user_id', 'question_id', 'event', 'action', 'body', 'timestamp')
+
+    def __init__(self, user_id, question_id, event, action, body):
+        self.user_id = user_id
+        self.question_id = question_id
+        self.event = event
+        self.action = action
+        self.body = body
+        self.timestamp = time.time()
+
+    def to_dict(self):
+        return {'t': round(self.timestamp, 3), 'user': self.user_id,
+                'question': self.question_id, 'event': self.event,
+                'action': self.action, 'body': self.body}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(',', ':'), sort_keys=True)
+
+    def __str__(self):
+        return self.to_json()
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        if isinstance(record.msg, StructuredEvent):
+            return record.msg.to_json()
+        return json.dumps({'t': round(record.created, 3), 'level': record.levelname,
+                           'logger': record.name, 'message': record.getMessage()},
+                          separators=(',', ':'))
+
+
+class QueueHandler(logging.Handler):
+    '''
+    Puts records on a queue, without formatting them. When the queue is full
+    the record is dropped and counted rather than blocking the request.
+    '''
+    def __init__(self, record_queue, listener=None):
+        logging.Handler.__init__(self)
+        self.queue = record_queue
+        self.listener = listener
+        self.dropped = 0
+        self._pid = os.getpid()
+
+    def emit(self, record):
+        if self._pid != os.getpid() and self.listener is not None:
+            # The listener thread did not survive a fork into this worker
+            self._pid = os.getpid()
+            self.listener.start()
+        if record.exc_info:
+            # Tracebacks cannot outlive this thread's stack frames
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueListener(object):
+    '''
+    Hands queued records to each logger's handlers, a batch at a time.
+    '''
+    def __init__(self, record_queue, handlers, batch_size=500, interval=0.25):
+        self.queue = record_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='LogListener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _take_batch(self):
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self.handle(self._take_batch())
+        self.handle(self._drain())
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def handle(self, batch):
+        if not batch:
+            return
+        by_logger = {}
+        for record in batch:
+            by_logger.setdefault(record.name, []).append(record)
+        for name, records in by_logger.items():
+            for handler in self.handlers.get(name, ()):
+                accepted = [record for record in records
+                            if record.levelno >= handler.level]
+                if not accepted:
+                    continue
+                try:
+                    if hasattr(handler, 'emit_batch'):
+                        handler.emit_batch(accepted)
+                    else:
+                        for record in accepted:
+                            handler.handle(record)
+                except Exception:
+                    handler.handleError(accepted[-1])
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class BatchRotatingFileHandler(logging.Handler):
+    '''
+    Appends batches of records to `filename` with a single write, moving the
+    file aside to `filename.1` (and so on, up to `backup_count`) once it
+    exceeds `max_bytes` or is older than `max_age` seconds.
+
+    Every worker process appends to the same file. Each batch is one
+    O_APPEND write, so batches from different processes never interleave;
+    the size is read from the file itself (`os.fstat`), not counted, so it
+    includes the other processes' writes; and a process that finds the file
+    has been replaced (its inode has changed, because another process
+    rotated it) reopens it rather than writing on into the moved-aside copy.
+    Rotation is done under a lock file, so only one process rotates.
+    '''
+    def __init__(self, filename, max_bytes=50 * 1024 * 1024, max_age=24 * 3600,
+                 backup_count=10):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.fd = None
+        self._open()
+
+    def _open(self):
+        self.fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.inode = os.fstat(self.fd).st_ino
+        self.opened = time.time()
+
+    def _reopen(self):
+        os.close(self.fd)
+        self._open()
+
+    def _moved(self):
+        try:
+            return os.stat(self.filename).st_ino != self.inode
+        except OSError:
+            return True
+
+    def _should_rotate(self, size):
+        return (size >= self.max_bytes or
+                (size and time.time() - self.opened >= self.max_age))
+
+    def _rotate(self):
+        with _file_lock(self.filename + '.lock'):
+            # Another process may have rotated it while this one waited
+            if not self._moved():
+                for index in range(self.backup_count - 1, 0, -1):
+                    source = '{}.{}'.format(self.filename, index)
+                    if os.path.exists(source):
+                        os.rename(source, '{}.{}'.format(self.filename, index + 1))
+                os.rename(self.filename, self.filename + '.1')
+            self._reopen()
+
+    def emit(self, record):
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        if not records:
+            return
+        text = ''.join(self.format(record) + '\n' for record in records)
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        if self._moved():
+            self._reopen()
+        if self._should_rotate(os.fstat(self.fd).st_size):
+            self._rotate()
+        written = 0
+        while written < len(text):
+            written += os.write(self.fd, text[written:])
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        logging.Handler.close(self)
+
+
+class _file_lock(object):
+    '''
+    An exclusive lock on `path` between processes; nothing, where fcntl is
+    not available.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+def setup_logging(app, level=logging.INFO):
+    '''
+    Route the SystemLogger to stdout, the ExternalInteractions logger to
+    INTERACTION_LOG_FILE and the SlowQueries logger to SLOW_QUERY_LOG_FILE
+    through a shared queue and listener. With
+    ASYNC_LOGGING off, the handlers are attached to the loggers directly.
+    '''
+    system_handler = logging.StreamHandler(sys.stdout)
+    system_handler.setLevel(level)
+    system_handler.setFormatter(logging.Formatter('%(name)s[%(levelname)s] - %(message)s'))
+    handlers = {'SystemLogger': [system_handler]}
+
+    log_file = app.config.get('INTERACTION_LOG_FILE')
+    if log_file:
+        directory = os.path.dirname(log_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        interaction_handler = BatchRotatingFileHandler(
+            log_file,
+            max_bytes=app.config.get('INTERACTION_LOG_MAX_BYTES', 50 * 1024 * 1024),
+            max_age=app.config.get('INTERACTION_LOG_MAX_AGE', 24 * 3600),
+            backup_count=app.config.get('INTERACTION_LOG_BACKUPS', 10))
+        interaction_handler.setFormatter(JsonLinesFormatter())
+        handlers['ExternalInteractions'] = [interaction_handler]
+
+    slow_query_file = app.config.get('SLOW_QUERY_LOG_FILE')
+    if slow_query_file:
+        slow_query_handler = BatchRotatingFileHandler(slow_query_file)
+        slow_query_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        handlers['SlowQueries'] = [slow_query_handler]
+
+    listener = None
+    if app.config.get('ASYNC_LOGGING', True):
+        record_queue = queue.Queue(app.config.get('LOG_QUEUE_SIZE', 100000))
+        listener = QueueListener(record_queue, handlers)
+        listener.start()
+        atexit.register(listener.stop)
+        queue_handler = QueueHandler(record_queue, listener)
+    for name, logger_handlers in handlers.items():
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.propagate = False
+        if listener is not None:
+            logger.addHandler(queue_handler)
+        else:
+            for handler in logger_handlers:
+                logger.addHandler(handler)
+    return listener
@@ -15,21 +15,16 @@ from flask import Flask
 # Initially build the flask appliation
 app = Flask(__name__)
 
-# Log any information from the application to the console
-# You might consider modifying this (e.g., log to a file instead)
-LOGGING_LEVEL = logging.INFO
-root = logging.getLogger('SystemLogger')
-root.setLevel(LOGGING_LEVEL)
-channel = logging.StreamHandler(sys.stdout)
-channel.setLevel(LOGGING_LEVEL)
-formatter = logging.Formatter('%(name)s[%(levelname)s] - %(message)s')
-channel.setFormatter(formatter)
-root.addHandler(channel)
-
 # Load in your application configuration
 # TODO: switch to config.ProductionConfig for the production server
 app.config.from_object('config.config.TestingConfig')
 
+# Log any information from the application to the console, and student
+# interactions to a file; both are written by a background thread.
+LOGGING_LEVEL = logging.INFO
+from interaction_logger import setup_logging
+log_listener = setup_logging(app, LOGGING_LEVEL)
+
 # Assign the VERSION to this application.
 VERSION = app.config['VERSION']
 
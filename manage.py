@@ -7,7 +7,11 @@ import sys, os
 
 from main import app
 from flask_script import Manager, Server
-from scripts.db_commands import ResetDB, PopulateDB, DisplayDB
+from scripts.db_commands import (ResetDB, PopulateDB, DisplayDB, MigrateIndexes,
+                                 ExportCourse, SyncReplicas)
+from scripts.bench_commands import (BenchHighlight, BenchLookups, StressLaunches,
+                                     BenchRoles, BenchLogging, Bench,
+                                     BenchWrites, ProfileStartup)
 
 context = (app.config["SERVER_CERTIFICATE_FILE"], 
            app.config["SERVER_KEY_FILE"])
@@ -22,6 +26,19 @@ manager.add_command("insecure", Server())
 manager.add_command("reset_db", ResetDB())
 manager.add_command("populate_db", PopulateDB())
 manager.add_command("display_db", DisplayDB())
+manager.add_command("migrate_indexes", MigrateIndexes())
+manager.add_command("export", ExportCourse())
+manager.add_command("sync_replicas", SyncReplicas())
+
+# Benchmark Commands
+manager.add_command("bench_highlight", BenchHighlight())
+manager.add_command("bench_lookups", BenchLookups())
+manager.add_command("stress_launches", StressLaunches())
+manager.add_command("bench_roles", BenchRoles())
+manager.add_command("bench_logging", BenchLogging())
+manager.add_command("bench", Bench())
+manager.add_command("bench_writes", BenchWrites())
+manager.add_command("profile_startup", ProfileStartup())
 
 if __name__ == "__main__":
     manager.run()
@@ -0,0 +1,98 @@
+'''
+Small, process-local caches used to keep hot lookups away from the database.
+
+Nothing in here is shared between worker processes; every entry carries a
+time-to-live so that a change made by another worker is picked up eventually,
+and the models explicitly invalidate entries when they see a row change.
+'''
+
+import time
+import threading
+from collections import OrderedDict
+
+
+def utf8_size(text):
+    '''
+    The size of `text` in bytes, once encoded as UTF-8: a `sizeof` for caches
+    of rendered pages, where len() would count characters.
+    '''
+    if isinstance(text, bytes):
+        return len(text)
+    return len(text.encode('utf-8'))
+
+
+class TTLCache(object):
+    '''
+    A thread-safe LRU mapping whose entries expire after `ttl` seconds.
+
+    The cache is bounded by `max_entries`, and optionally by `max_size`, where
+    the size of each value is measured by the `sizeof` function. The least
+    recently used entries are evicted first.
+    '''
+    def __init__(self, max_entries=1024, ttl=300, max_size=None, sizeof=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires, size = entry
+            if self.ttl is not None and expires < time.time():
+                self.size -= size
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        if self.max_size is not None and size > self.max_size:
+            return value
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self._entries[key] = (value, expires, size)
+            self.size += size
+            while (len(self._entries) > self.max_entries or
+                   (self.max_size is not None and self.size > self.max_size)):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+
+    def discard_where(self, predicate):
+        '''
+        Remove every entry for which `predicate(key, value)` is true.
+        '''
+        with self._lock:
+            doomed = [key for key, (value, _, _) in self._entries.items()
+                      if predicate(key, value)]
+            for key in doomed:
+                self.size -= self._entries.pop(key)[2]
+        return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
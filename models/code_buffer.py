@@ -0,0 +1,299 @@
+'''
+Coalesces the stream of `save_code` calls a student's editor makes.
+
+Clients save on every edit, but only the latest code matters, so the latest
+code for each (user, assignment) is kept in memory and written to the database
+once the student has paused for `quiet_period` seconds (or, while they keep
+typing, at least every `max_delay` seconds). Anything that reads a submission
+calls `flush` first, so readers in this process never see stale code. Readers
+in other processes may lag by up to `max_delay` seconds.
+
+Several processes may hold code for the same submission (say, two workers
+behind a load balancer). Each write only applies if the submission is still
+at the version it was read at; if another process has written it since, the
+write starts over from that process's version, so the version keeps counting
+every save and the most recently written code wins.
+
+Clients may also send a patch against a submission version they already have,
+instead of the whole program; see `patch`.
+'''
+
+import os
+import time
+import atexit
+import logging
+import threading
+
+from sqlalchemy import bindparam, func, select
+
+logger = logging.getLogger('SystemLogger')
+
+# Times a write finding no submission row is tried again before the code is
+# dropped: a submission created in a request that has not committed yet is
+# not there for writes on other connections
+MISSING_ROW_ATTEMPTS = 5
+
+
+class PendingCode(object):
+    def __init__(self, submission_id, code, version):
+        self.submission_id = submission_id
+        self.code = code
+        # The version in the database, and how many saves are not there yet
+        self.version = version
+        self.touches = 0
+        self.first_touch = self.last_touch = time.time()
+        self.missing = 0
+
+    def touch(self, code):
+        self.code = code
+        self.touches += 1
+        self.last_touch = time.time()
+
+    @property
+    def current_version(self):
+        return self.version + self.touches
+
+
+def _key(user_id, assignment_id):
+    # Ids arrive from forms as strings, and from the models as ints
+    return (int(user_id), int(assignment_id))
+
+
+def apply_patch(code, patch):
+    '''
+    Applies a list of [start, end, replacement] edits, in order, to `code`.
+    Each edit's offsets refer to the code as left by the previous edit.
+    Raises ValueError for anything else.
+    '''
+    if not isinstance(patch, list):
+        raise ValueError("A patch is a list of edits")
+    for edit in patch:
+        if not (isinstance(edit, list) and len(edit) == 3 and
+                all(isinstance(offset, int) and not isinstance(offset, bool)
+                    for offset in edit[:2]) and
+                isinstance(edit[2], (type(u''), str))):
+            raise ValueError("Each edit is a [start, end, replacement] list")
+        start, end, replacement = edit
+        if not 0 <= start <= end <= len(code):
+            raise ValueError("Edit [{}, {}] is outside the code".format(start, end))
+        code = code[:start] + replacement + code[end:]
+    return code
+
+
+class CodeBuffer(object):
+    def __init__(self, app, db, table, load, quiet_period=2.0, max_delay=10.0,
+                 unit_of_work=None):
+        '''
+        `load(user_id, assignment_id)` must return the (id, code, version) of
+        the submission, creating it if necessary; `table` is its Table.
+        
+        `unit_of_work()`, if given, returns the (session, after_end) of a
+        transaction the calling thread has open, or None. Writes are then
+        made in that transaction rather than on a connection of their own,
+        and `after_end(callback)` must call `callback(committed)` once it
+        ends; the code is kept for a later write if it rolls back.
+        '''
+        self.app = app
+        self.db = db
+        self.table = table
+        self.load = load
+        self.unit_of_work = unit_of_work
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.saves = 0
+        self.writes = 0
+        self.conflicts = 0
+        self._pending = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def stats(self):
+        return {'saves': self.saves, 'writes': self.writes,
+                'conflicts': self.conflicts, 'pending': len(self._pending)}
+
+    def _entry(self, user_id, assignment_id):
+        '''
+        Find (or start) the pending entry for this key. Must not be called
+        with the lock held, since starting an entry may read the database.
+        '''
+        key = _key(user_id, assignment_id)
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                in_flight = self._in_flight.get(key)
+                if in_flight is not None:
+                    entry = PendingCode(in_flight.submission_id, in_flight.code,
+                                        in_flight.current_version)
+                    self._pending[key] = entry
+            if entry is not None:
+                return entry
+        submission_id, code, version = self.load(user_id, assignment_id)
+        with self._lock:
+            return self._pending.setdefault(key, PendingCode(submission_id, code, version))
+
+    def save(self, user_id, assignment_id, code):
+        '''
+        Record the latest code; returns the new submission version.
+        '''
+        entry = self._entry(user_id, assignment_id)
+        with self._lock:
+            entry.touch(code)
+            self.saves += 1
+            version = entry.current_version
+        self._schedule(user_id, assignment_id)
+        return version
+
+    def patch(self, user_id, assignment_id, base_version, patch):
+        '''
+        Apply `patch` to the code at `base_version`. Returns the new version,
+        or None if the submission has moved on since `base_version`, in which
+        case the client must send the whole program.
+        '''
+        entry = self._entry(user_id, assignment_id)
+        with self._lock:
+            if entry.current_version != base_version:
+                return None
+            entry.touch(apply_patch(entry.code, patch))
+            self.saves += 1
+            version = entry.current_version
+        self._schedule(user_id, assignment_id)
+        return version
+
+    def _schedule(self, user_id, assignment_id):
+        if self.quiet_period <= 0:
+            self.flush(user_id, assignment_id)
+            return
+        if self._pid != os.getpid() or self._thread is None:
+            with self._lock:
+                if self._pid != os.getpid() or self._thread is None:
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._run, name='CodeBuffer')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.quiet_period / 2.0)
+            now = time.time()
+            self._write(lambda entry: (now - entry.last_touch >= self.quiet_period or
+                                       now - entry.first_touch >= self.max_delay))
+
+    def flush(self, user_id=None, assignment_id=None):
+        '''
+        Write pending code now: just for one (user, assignment), or everything.
+        Returns True if anything was written, here or, for one (user,
+        assignment), by another thread this waited for.
+        '''
+        if user_id is None:
+            return self._write(lambda entry: True)
+        key = _key(user_id, assignment_id)
+        if key not in self._pending and key not in self._in_flight:
+            return False
+        written = self._write(lambda entry: True, keys=[key])
+        # Another thread may be in the middle of writing it
+        deadline = time.time() + 5
+        with self._written:
+            while key in self._in_flight and time.time() < deadline:
+                written = True
+                self._written.wait(deadline - time.time())
+        return written
+
+    def _write(self, is_due, keys=None):
+        joined = self.unit_of_work() if self.unit_of_work is not None else None
+        with self._lock:
+            candidates = self._pending if keys is None else keys
+            due = {}
+            for key in list(candidates):
+                entry = self._pending.get(key)
+                if entry is not None and is_due(entry):
+                    due[key] = self._in_flight[key] = self._pending.pop(key)
+        if not due:
+            return False
+        missing = {}
+        try:
+            if joined is not None:
+                session, after_end = joined
+                missing = self._write_entries(session, due)
+                written = dict((key, entry) for key, entry in due.items() if key not in missing)
+                after_end(lambda committed: self._ended(written, committed))
+            else:
+                # Not through an app context of its own: ending one removes
+                # the thread's session, which may be a request's
+                with self.db.get_engine(self.app).begin() as connection:
+                    missing = self._write_entries(connection, due)
+                self.writes += len(due) - len(missing)
+            self._retry_missing(missing)
+        except Exception:
+            logger.exception("Could not save code for {} submissions".format(len(due)))
+            self._restore(due)
+            return False
+        finally:
+            with self._lock:
+                for key, entry in due.items():
+                    if self._in_flight.get(key) is entry:
+                        del self._in_flight[key]
+                self._written.notify_all()
+        return len(missing) < len(due)
+
+    def _write_entries(self, connection, due):
+        # Returns the entries whose submission row was not found
+        return dict((key, entry) for key, entry in due.items()
+                    if not self._write_entry(connection, entry))
+
+    def _retry_missing(self, missing):
+        retry = {}
+        for key, entry in missing.items():
+            entry.missing += 1
+            if entry.missing < MISSING_ROW_ATTEMPTS:
+                retry[key] = entry
+            else:
+                logger.warning("Dropped the code for submission {}, which was still missing "
+                               "after {} writes".format(entry.submission_id, entry.missing))
+        self._restore(retry)
+
+    def _restore(self, due):
+        with self._lock:
+            # Put them back, unless newer code has arrived since
+            for key, entry in due.items():
+                if key not in self._pending:
+                    self._pending[key] = entry
+
+    def _ended(self, due, committed):
+        if committed:
+            self.writes += len(due)
+        else:
+            self._restore(due)
+
+    def _write_entry(self, connection, entry, attempts=3):
+        '''
+        Write one entry, through a connection or a session, if the submission
+        is still at the version it was read at; if another process has
+        written it since, re-read the version and write on top of it. Returns
+        False if there is no such submission, as far as `connection` can see.
+        '''
+        table = self.table
+        update = (table.update()
+                       .where(table.c.id == entry.submission_id)
+                       .where(table.c.version == bindparam('expected_version')))
+        for attempt in range(attempts):
+            with self._lock:
+                code, version, touches = entry.code, entry.version, entry.touches
+            result = connection.execute(update.values(code=code, version=version + touches,
+                                                      date_modified=func.current_timestamp()),
+                                        {'expected_version': version})
+            if result.rowcount:
+                return True
+            written_version = connection.execute(select([table.c.version])
+                                                 .where(table.c.id == entry.submission_id)).scalar()
+            if written_version is None:
+                return False
+            with self._lock:
+                self.conflicts += 1
+                entry.version = written_version
+        logger.warning("Gave up saving code for submission {} after {} conflicting writes".format(
+                       entry.submission_id, attempts))
+        return True
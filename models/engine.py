@@ -0,0 +1,200 @@
+'''
+Database engine settings.
+
+SQLite connections get SQLITE_PRAGMAS as soon as they are opened; the
+defaults put the database in WAL mode, so readers no longer block (or are
+blocked by) the writer, make commits cheaper with synchronous=NORMAL, and
+have writers wait busy_timeout milliseconds for the lock rather than failing
+with "database is locked".
+
+SQLite transactions of the application's engines are run by SQLAlchemy
+rather than pysqlite, so that SAVEPOINTs work, and begin as plain (deferred)
+read transactions. A read transaction cannot take the write lock once another
+connection has committed since it began, and SQLite fails such an upgrade at
+once, busy_timeout or not; so the first write of a transaction (or its first
+SAVEPOINT, which here always precedes one) ends the read transaction and
+begins again with BEGIN IMMEDIATE, which waits for the lock. Reads made
+before the first write therefore see the database as of when they ran,
+much as under READ COMMITTED on a server database.
+
+Server databases (MySQL, PostgreSQL) get a connection pool sized by
+DATABASE_POOL_SIZE and DATABASE_MAX_OVERFLOW, whose connections are recycled
+after DATABASE_POOL_RECYCLE seconds and, with DATABASE_POOL_PRE_PING, checked
+before use so that connections the server dropped are replaced.
+
+Views decorated with `replica_reads` query one of SQLALCHEMY_REPLICA_BINDS
+(names from SQLALCHEMY_BINDS) instead of the primary. Once a session writes
+anything (a flush, or an INSERT/UPDATE/DELETE statement) it uses the primary
+for the rest of its life, that is, the rest of the request, so it always
+reads back its own writes, whatever the replicas' lag.
+'''
+
+import re
+import random
+import functools
+import threading
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+DEFAULT_SQLITE_PRAGMAS = (('busy_timeout', 5000), ('journal_mode', 'WAL'),
+                          ('synchronous', 'NORMAL'), ('mmap_size', 256 * 1024 * 1024))
+
+
+def tune_sqlite(engine, pragmas=DEFAULT_SQLITE_PRAGMAS):
+    '''
+    Run the (name, value) `pragmas`, in order, on every new connection of a
+    SQLite `engine`; other engines are left alone.
+    '''
+    if engine.dialect.name != 'sqlite' or not pragmas:
+        return engine
+    statements = ['PRAGMA {}={}'.format(name, value) for name, value in pragmas]
+
+    @event.listens_for(engine, 'connect')
+    def _apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        finally:
+            cursor.close()
+    return engine
+
+
+_WRITE_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+
+def sqlite_transactions(engine):
+    '''
+    Have SQLAlchemy begin the transactions of a SQLite `engine`, and move
+    each to BEGIN IMMEDIATE at its first write (see above); other engines
+    are left alone.
+    '''
+    if engine.dialect.name != 'sqlite':
+        return engine
+
+    @event.listens_for(engine, 'connect')
+    def _take_over_transactions(dbapi_connection, connection_record):
+        # pysqlite would otherwise BEGIN by itself, and COMMIT before SAVEPOINTs
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def _begin(connection):
+        connection.info['sqlite_writing'] = False
+        connection.execute('BEGIN')
+
+    def _start_writing(connection):
+        if connection.info.get('sqlite_writing', True) or not connection.in_transaction():
+            return
+        cursor = connection.connection.cursor()
+        try:
+            # Nothing has been written yet, so nothing is lost
+            cursor.execute('COMMIT')
+            try:
+                cursor.execute('BEGIN IMMEDIATE')
+            except connection.dialect.dbapi.Error as e:
+                # Still in a transaction, for SQLAlchemy to end; the next
+                # write tries again
+                cursor.execute('BEGIN')
+                raise exc.OperationalError('BEGIN IMMEDIATE', (), e)
+        finally:
+            cursor.close()
+        connection.info['sqlite_writing'] = True
+
+    @event.listens_for(engine, 'savepoint')
+    def _savepoint(connection, name):
+        _start_writing(connection)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_write(connection, cursor, statement, parameters, context, executemany):
+        if _WRITE_STATEMENT.match(statement):
+            _start_writing(connection)
+    return engine
+
+
+def server_pool_options(config):
+    return {'pool_size': config.get('DATABASE_POOL_SIZE', 10),
+            'max_overflow': config.get('DATABASE_MAX_OVERFLOW', 20),
+            'pool_recycle': config.get('DATABASE_POOL_RECYCLE', 1800),
+            'pool_timeout': config.get('DATABASE_POOL_TIMEOUT', 30),
+            'pool_pre_ping': config.get('DATABASE_POOL_PRE_PING', True)}
+
+
+def replica_reads(view):
+    '''
+    Let the decorated view read from a replica, until it writes.
+    '''
+    @functools.wraps(view)
+    def decorated(*args, **kwargs):
+        g.read_replica = True
+        return view(*args, **kwargs)
+    return decorated
+
+
+def _reading_from_replica():
+    return has_app_context() and getattr(g, 'read_replica', False)
+
+
+class RoutingSession(SignallingSession):
+    '''
+    A session that sends the reads of `replica_reads` views to a replica,
+    and everything else (or anything after a write) to the primary.
+    '''
+    def __init__(self, db, **options):
+        self.routing_db = db
+        self.wrote = False
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.wrote = True
+        elif not self.wrote and _reading_from_replica():
+            replicas = self.app.config.get('SQLALCHEMY_REPLICA_BINDS')
+            if replicas and _default_bind(mapper):
+                return self.routing_db.get_engine(self.app, bind=random.choice(replicas))
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+def _default_bind(mapper):
+    # Models with their own __bind_key__ are not replicated
+    if mapper is None:
+        return True
+    table = getattr(mapper, 'persist_selectable', None)
+    if table is None:
+        table = mapper.mapped_table
+    return getattr(table, 'info', {}).get('bind_key') is None
+
+
+class TunedSQLAlchemy(SQLAlchemy):
+    '''
+    Flask-SQLAlchemy, with the server pool settings above taken from the
+    config and sessions routed by `RoutingSession`. Every SQLite engine,
+    replicas included, is tuned with `tune_sqlite` and has its transactions
+    managed by `sqlite_transactions` when it is created.
+    '''
+    def __init__(self, *args, **kwargs):
+        self._tuned_engines = set()
+        self._tuning_lock = threading.Lock()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def apply_driver_hacks(self, app, info, options):
+        result = SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if not info.drivername.startswith('sqlite'):
+            options.update(server_pool_options(app.config))
+        return result
+
+    def get_engine(self, app=None, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine not in self._tuned_engines:
+            with self._tuning_lock:
+                if engine not in self._tuned_engines:
+                    config = self.get_app(app).config
+                    tune_sqlite(engine, config.get('SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS))
+                    sqlite_transactions(engine)
+                    self._tuned_engines.add(engine)
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,128 @@
+'''
+A write-behind buffer for high-volume, append-only rows (such as Logs).
+
+Rows are queued in memory by the request thread and written by a background
+thread in bulk, either every `batch_size` rows or every `interval` seconds,
+whichever comes first. The queue is bounded: when it is full, producers wait
+up to `put_timeout` seconds for room before the row is dropped and counted.
+'''
+
+import os
+import time
+import atexit
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+logger = logging.getLogger('SystemLogger')
+
+
+class EventSink(object):
+    def __init__(self, app, db, table, max_queue=10000, batch_size=200,
+                 interval=0.5, put_timeout=0.05):
+        self.app = app
+        self.db = db
+        self.table = table
+        self.batch_size = batch_size
+        self.interval = interval
+        self.put_timeout = put_timeout
+        self.queued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.stop)
+
+    def stats(self):
+        return {'queued': self.queued, 'flushed': self.flushed,
+                'dropped': self.dropped, 'failed': self.failed,
+                'pending': self._queue.qsize()}
+
+    def put(self, row):
+        '''
+        Queue a dictionary of column values. Returns False if the row had to
+        be dropped because the queue stayed full.
+        '''
+        self._ensure_started()
+        try:
+            self._queue.put(row, timeout=self.put_timeout)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        return True
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so a preloaded parent's worker must
+        # be replaced in every child process.
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pid = os.getpid()
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run,
+                                                name='EventSink-' + self.table.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _take_batch(self):
+        batch = []
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as connection:
+                    connection.execute(self.table.insert(), batch)
+            self.flushed += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception("Could not write {} rows to {}".format(len(batch), self.table.name))
+
+    def flush(self):
+        '''
+        Synchronously write everything that is currently queued.
+        '''
+        batch = self._drain()
+        for start in range(0, len(batch), self.batch_size):
+            self._write(batch[start:start+self.batch_size])
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self._thread = None
+        self.flush()
@@ -3,20 +3,28 @@ import time
 import re
 import os
 import json
+import random
+import threading
 from pprint import pprint
 import logging
 
 from main import app
+from flask import g, has_app_context
 
-from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
+from sqlalchemy.exc import IntegrityError, OperationalError
 from flask_security import UserMixin, RoleMixin, login_required
 from sqlalchemy import event, Integer, Date, ForeignKey, Column, Table,\
                        String, Boolean, DateTime, Text, ForeignKeyConstraint,\
-                       cast, func
+                       cast, func, Index, or_, and_, select, inspect
 from sqlalchemy.ext.declarative import declared_attr
 
-db = SQLAlchemy(app)
+from .cache import TTLCache, utf8_size
+from .event_sink import EventSink
+from .code_buffer import CodeBuffer
+from .engine import TunedSQLAlchemy
+
+db = TunedSQLAlchemy(app)
 Model = db.Model
 relationship = db.relationship
 backref = db.backref
@@ -28,6 +36,178 @@ def ensure_dirs(path):
         if not os.path.isdir(path):
             app.logger.warning(e.args + (path, ) )
 
+# Resolved LTI identities, so that polling endpoints do not have to look up
+# who the user is on every request. Keys are ('user', service, lti_user_id)
+# and ('course', service, lti_context_id); values are primary keys.
+identity_cache = TTLCache(max_entries=app.config.get('IDENTITY_CACHE_SIZE', 10000),
+                          ttl=app.config.get('IDENTITY_CACHE_TTL', 600))
+
+def _forget_identity(kind, row_id):
+    identity_cache.discard_where(lambda key, value: key[0] == kind and value == row_id)
+
+# A request's unit of work: inside one, the model helpers below only flush
+# their changes, and the request commits them all at once when it finishes
+# (see controllers/__init__.py), so that a launch costs one commit rather than
+# one per row created. Anywhere else (manage.py commands, background threads)
+# they commit straight away. Writes made through the `log_sink` have their own
+# connection and are never part of it; code the `code_buffer` writes during a
+# unit of work is (see `_code_buffer_unit_of_work`).
+def in_unit_of_work():
+    return has_app_context() and getattr(g, 'unit_of_work', None) is not None
+
+def begin_unit_of_work():
+    g.unit_of_work = []
+
+def end_unit_of_work(commit=True):
+    """
+    Commit (or roll back) the unit of work's changes, then run the callbacks
+    registered with `after_unit_of_work`.
+    """
+    callbacks, g.unit_of_work = g.unit_of_work, None
+    committed = False
+    try:
+        if commit:
+            # One that only read has nothing to commit; ending its transaction
+            # with a rollback saves the database a commit
+            db.session.flush()
+            if db.session().wrote:
+                db.session.commit()
+            else:
+                db.session.rollback()
+            committed = True
+        else:
+            db.session.rollback()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        for callback in callbacks:
+            try:
+                callback(committed)
+            except Exception:
+                app.logger.exception("Callback after the unit of work failed")
+
+def after_unit_of_work(callback):
+    """
+    Call `callback(committed)` once the unit of work commits or rolls back,
+    or straight away (with True) if there is none.
+    """
+    if in_unit_of_work():
+        g.unit_of_work.append(callback)
+    else:
+        callback(True)
+
+def after_commit(callback, *args):
+    """
+    Call `callback(*args)` only once the current changes are committed.
+    """
+    after_unit_of_work(lambda committed: callback(*args) if committed else None)
+
+def save_changes():
+    """
+    What the helpers call instead of committing: a flush inside a unit of
+    work, a commit outside one.
+    """
+    if in_unit_of_work():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+class _Creation(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.instance_id = None
+        self.session = None
+
+_creations = {}
+_creations_lock = threading.Lock()
+# Longest wait for another creator before going to the database anyway, in
+# case two units of work are each waiting for the other's row
+CREATION_WAIT = 10
+
+def get_or_create(model, create, **keys):
+    '''
+    Returns `(instance, created)` for the `model` row matching `keys`, calling
+    `create()` to build one if none exists.
+    
+    Safe against concurrent creators: the insert happens in a SAVEPOINT, and if
+    a unique index on `keys` rejects it because another worker got there
+    first, the other worker's row is returned instead. Within a process,
+    concurrent calls for the same key wait for the first one rather than
+    racing it to the database; when it creates the row inside a unit of work,
+    they wait until that commits, since they could not see the row before.
+    '''
+    flight_key = (model.__tablename__,) + tuple(sorted(keys.items()))
+    session = db.session()
+    with _creations_lock:
+        creation = _creations.get(flight_key)
+        leader = creation is None
+        if leader:
+            creation = _creations[flight_key] = _Creation()
+            creation.session = session
+    # The same unit of work can already see its own row; and one that has
+    # already written holds the database's write lock, which the leader may
+    # be waiting for, so it goes straight to the database instead
+    if (not leader and creation.session is not session and
+            not (in_unit_of_work() and session.wrote)):
+        creation.done.wait(CREATION_WAIT)
+        if creation.instance_id is not None:
+            instance = model.query.get(creation.instance_id)
+            if instance is not None:
+                return instance, False
+    created = False
+    try:
+        instance, created = _get_or_create(model, create, keys)
+        creation.instance_id = instance.id
+        return instance, created
+    finally:
+        if leader:
+            def land(committed=True):
+                with _creations_lock:
+                    del _creations[flight_key]
+                creation.done.set()
+            if created:
+                after_unit_of_work(land)
+            else:
+                land()
+
+def _get_or_create(model, create, keys, attempts=8):
+    # Starting over would throw away whatever the unit of work already wrote
+    can_restart = not (in_unit_of_work() and db.session().wrote)
+    for attempt in range(attempts):
+        instance = model.query.filter_by(**keys).first()
+        if instance is not None:
+            return instance, False
+        try:
+            with db.session.begin_nested():
+                instance = create()
+                db.session.add(instance)
+            save_changes()
+            return instance, True
+        except IntegrityError:
+            if can_restart:
+                # Don't keep the write lock the insert took while the caller
+                # goes on (possibly to wait for another creation)
+                db.session.rollback()
+            return model.query.filter_by(**keys).one(), False
+        except OperationalError as e:
+            # The write lock was still not free after the busy timeout; start
+            # the transaction over.
+            if 'locked' not in str(e) or attempt == attempts - 1 or not can_restart:
+                raise
+            db.session.rollback()
+            time.sleep(random.uniform(0, 0.01 * 2 ** attempt))
+
+# LTI context roles, packed into a bitmask once per launch
+LTI_CONTEXT_ROLE_URN = 'urn:lti:role:ims/lis/'
+LTI_ROLE_BITS = {'Learner': 1, 'Instructor': 2, 'TeachingAssistant': 4,
+                 'ContentDeveloper': 8, 'Mentor': 16, 'Administrator': 32,
+                 'Member': 64, 'Manager': 128}
+LTI_INSTRUCTOR_MASK = (LTI_ROLE_BITS['Instructor'] | LTI_ROLE_BITS['TeachingAssistant'] |
+                       LTI_ROLE_BITS['ContentDeveloper'])
+# Memo of raw role strings seen so far; there are only a handful per LMS
+_lti_role_masks = {}
+
 class Base(Model):
     __abstract__  = True
     @declared_attr
@@ -47,7 +227,7 @@ class User(Base, UserMixin):
     id = Column(Integer(), primary_key=True)
     first_name = Column(String(255))
     last_name = Column(String(255))
-    email = Column(String(255))
+    email = Column(String(255), index=True)
     gender = Column(String(255), default='Unspecified')
     picture = Column(String(255), default='') # A url
     proof = Column(String(255), default=None)
@@ -66,40 +246,82 @@ class User(Base, UserMixin):
     def name(self):
         return ' '.join((self.first_name, self.last_name))
         
+    def role_names(self):
+        '''
+        The lowercased names of this user's roles. Within a request they are
+        only loaded once, however many permission checks are made.
+        '''
+        if not has_app_context():
+            return frozenset(role.name.lower() for role in self.roles)
+        if not hasattr(g, 'role_names_by_user'):
+            g.role_names_by_user = {}
+        names = g.role_names_by_user.get(self.id)
+        if names is None:
+            names = frozenset(role.name.lower() for role in self.roles)
+            g.role_names_by_user[self.id] = names
+        return names
+        
     def is_admin(self):
-        return 'admin' in {role.name.lower() for role in self.roles}
+        return 'admin' in self.role_names()
     
     def is_instructor(self):
-        return 'instructor' in {role.name.lower() for role in self.roles}
+        return 'instructor' in self.role_names()
+        
+    @staticmethod
+    def lti_role_mask(given_roles):
+        '''
+        Packs LTI context roles (a comma-separated string, or a list) into a
+        bitmask of LTI_ROLE_BITS. Both the short ("Instructor") and the URN
+        ("urn:lti:role:ims/lis/Instructor") forms are understood, sub-roles
+        count as their parent role, and institution/system roles are ignored.
+        '''
+        if isinstance(given_roles, (list, tuple)):
+            given_roles = ','.join(given_roles)
+        mask = _lti_role_masks.get(given_roles)
+        if mask is None:
+            mask = 0
+            for role in given_roles.split(','):
+                role = role.strip()
+                if role.startswith(LTI_CONTEXT_ROLE_URN):
+                    role = role[len(LTI_CONTEXT_ROLE_URN):]
+                elif role.startswith('urn:'):
+                    continue
+                mask |= LTI_ROLE_BITS.get(role.split('/')[0], 0)
+            if len(_lti_role_masks) < 1024:
+                _lti_role_masks[given_roles] = mask
+        return mask
         
     @staticmethod
     def is_lti_instructor(given_roles):
-        ROLES = ["urn:lti:role:ims/lis/TeachingAssistant",
-                 "Instructor", "ContentDeveloper",
-                 "urn:lti:role:ims/lis/Instructor",
-                 "urn:lti:role:ims/lis/ContentDeveloper"]
-        return any(role for role in ROLES if role in given_roles)
+        '''
+        Accepts either raw LTI roles or a mask from `lti_role_mask`.
+        '''
+        if not isinstance(given_roles, int):
+            given_roles = User.lti_role_mask(given_roles)
+        return bool(given_roles & LTI_INSTRUCTOR_MASK)
         
     @staticmethod
     def new_lti_user(service, lti_user_id, lti_email, lti_first_name, lti_last_name):
-        new_user = User(first_name=lti_first_name, last_name=lti_last_name, email=lti_email, 
-                        password="", active=False, confirmed_at=None)
-        db.session.add(new_user)
-        db.session.flush()
-        new_authentication = Authentication(type=service, 
-                                            value=lti_user_id,
-                                            user_id=new_user.id)
-        db.session.add(new_authentication)
-        db.session.commit()
-        return new_user
+        def create():
+            new_user = User(first_name=lti_first_name, last_name=lti_last_name, email=lti_email, 
+                            password="", active=False, confirmed_at=None)
+            db.session.add(new_user)
+            db.session.flush()
+            return Authentication(type=service, 
+                                  value=lti_user_id,
+                                  user_id=new_user.id)
+        authentication, created = get_or_create(Authentication, create,
+                                                type=service, value=lti_user_id)
+        return authentication.user
         
     def register_authentication(self, service, lti_user_id):
-        new_authentication = Authentication(type=service, 
-                                            value=lti_user_id,
-                                            user_id=self.id)
-        db.session.add(new_authentication)
-        db.session.commit()
-        return self
+        def create():
+            return Authentication(type=service, 
+                                  value=lti_user_id,
+                                  user_id=self.id)
+        authentication, created = get_or_create(Authentication, create,
+                                                type=service, value=lti_user_id)
+        return authentication.user
         
     @staticmethod
     def from_lti(service, lti_user_id, lti_email, lti_first_name, lti_last_name):
@@ -111,29 +333,52 @@ class User(Base, UserMixin):
         if lti is None:
             user = User.query.filter_by(email=lti_email).first()
             if user:
-                user.register_authentication(service, lti_user_id)
-                return user
+                return user.register_authentication(service, lti_user_id)
             else:
                 return User.new_lti_user(service, lti_user_id, lti_email, lti_first_name, lti_last_name)
         else:
             return lti.user
+    
+    @staticmethod
+    def id_from_lti(service, lti_user_id, lti_email, lti_first_name, lti_last_name):
+        """
+        Like `from_lti`, but only returns the user's id, and remembers it so
+        that later requests in the same process skip the database entirely.
+        """
+        key = ('user', service, lti_user_id)
+        user_id = identity_cache.get(key)
+        if user_id is None:
+            user_id = User.from_lti(service, lti_user_id, lti_email, 
+                                    lti_first_name, lti_last_name).id
+            # A user created by this request only exists once it commits
+            after_commit(identity_cache.set, key, user_id)
+        return user_id
+        
+    @staticmethod
+    def by_id(user_id):
+        return User.query.get(user_id)
         
 class Course(Base):
     name = Column(String(255))
     owner_id = Column(Integer(), ForeignKey('user.id'))
     service = Column(String(80), default="")
-    external_id = Column(String(255), default="")
+    # NULL for native courses
+    external_id = Column(String(255), default=None)
+    
+    # Each LMS course has exactly one Course. Every database lets a unique
+    # index hold any number of NULLs, so native courses need no partial index.
+    __table_args__ = (Index('ix_course_external_id', 'external_id', unique=True),)
     
     def __str__(self):
         return '<Course {}>'.format(self.id)
         
     @staticmethod
     def new_lti_course(service, external_id, name, user_id):
-        new_course = Course(name=name, owner_id=user_id,
-                            service=service, external_id=external_id)
-        db.session.add(new_course)
-        db.session.commit()
-        return new_course
+        def create():
+            return Course(name=name, owner_id=user_id,
+                          service=service, external_id=external_id)
+        course, created = get_or_create(Course, create, external_id=external_id)
+        return course
         
     @staticmethod
     def from_lti(service, lti_context_id, name, user_id):
@@ -146,9 +391,22 @@ class Course(Base):
         else:
             return lti_course
     
+    @staticmethod
+    def id_from_lti(service, lti_context_id, name, user_id):
+        key = ('course', service, lti_context_id)
+        course_id = identity_cache.get(key)
+        if course_id is None:
+            course_id = Course.from_lti(service, lti_context_id, name, user_id).id
+            after_commit(identity_cache.set, key, course_id)
+        return course_id
+        
+    @staticmethod
+    def by_id(course_id):
+        return Course.query.get(course_id)
+    
 class Role(Base, RoleMixin):
     name = Column(String(80))
-    user_id = Column(Integer(), ForeignKey('user.id'))
+    user_id = Column(Integer(), ForeignKey('user.id'), index=True)
     course_id = Column(Integer(), ForeignKey('course.id'), default=None)
     
     NAMES = ['teacher', 'admin', 'student']
@@ -159,7 +417,10 @@ class Role(Base, RoleMixin):
 class Authentication(Base):
     type = Column(String(80))
     value = Column(String(255))
-    user_id = Column(Integer(), ForeignKey('user.id'))
+    user_id = Column(Integer(), ForeignKey('user.id'), index=True)
+    
+    # Each external identity belongs to exactly one user
+    __table_args__ = (Index('ix_authentication_type_value', 'type', 'value', unique=True),)
     
     TYPES = ['local', 'canvas']
     
@@ -183,22 +444,128 @@ class Submission(Base):
     assignment_version = Column(Integer(), default=0)
     version = Column(Integer(), default=0)
     
+    # Each user has exactly one submission per assignment
+    __table_args__ = (Index('ix_submission_assignment_user', 'assignment_id', 'user_id', unique=True),
+                      Index('ix_submission_user_id', 'user_id'))
+    
     def __str__(self):
         return '<Submission {} for {}>'.format(self.id, self.user_id)
         
+    @staticmethod
+    def default_explanation(code):
+        return {'code': code, 'elements': {}}
+        
+    @staticmethod
+    def starting_code(assignment):
+        if assignment.mode == 'explain':
+            return json.dumps(Submission.default_explanation(''))
+        else:
+            return assignment.on_start
+        
     @staticmethod
     def load(user_id, assignment_id):
+        _flush_code(user_id, assignment_id)
         submission = Submission.query.filter_by(assignment_id=assignment_id, 
                                                 user_id=user_id).first()
         if not submission:
-            submission = Submission(assignment_id=assignment_id, user_id=user_id)
-            assignment = Assignment.by_id(assignment_id)
-            if assignment.mode == 'explain':
-                submission.code = json.dumps(Submission.default_explanation(''))
-            else:
-                submission.code = assignment.on_start
-            db.session.add(submission)
-            db.session.commit()
+            def create():
+                assignment = Assignment.by_id(assignment_id)
+                return Submission(assignment_id=assignment_id, user_id=user_id,
+                                  code=Submission.starting_code(assignment))
+            submission, created = get_or_create(Submission, create,
+                                                assignment_id=assignment_id,
+                                                user_id=user_id)
+        return submission
+        
+    @staticmethod
+    def load_many(user_id, assignments):
+        """
+        Loads the user's submissions for each of the given assignments, in the
+        same order, creating any that are missing. Uses the same handful of
+        queries no matter how many assignments there are.
+        """
+        if not assignments:
+            return []
+        assignment_ids = [assignment.id for assignment in assignments]
+        for assignment_id in assignment_ids:
+            _flush_code(user_id, assignment_id)
+        def fetch():
+            return {submission.assignment_id: submission
+                    for submission in (Submission.query
+                                                 .filter_by(user_id=user_id)
+                                                 .filter(Submission.assignment_id.in_(assignment_ids)))}
+        submissions = fetch()
+        missing = {}
+        for assignment in assignments:
+            if assignment.id not in submissions:
+                missing[assignment.id] = {'assignment_id': assignment.id,
+                                          'user_id': user_id,
+                                          'code': Submission.starting_code(assignment)}
+        if missing:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(Submission.__table__.insert(), list(missing.values()))
+            except IntegrityError:
+                # Somebody else created some of them first; settle each one
+                for assignment_id in missing:
+                    Submission.load(user_id, assignment_id)
+            save_changes()
+            submissions = fetch()
+        return [submissions[assignment_id] for assignment_id in assignment_ids]
+        
+    @staticmethod
+    def validators(submission_id):
+        """
+        The (id, user_id, assignment_id, version, date_modified) of a
+        submission, without its code, for conditional responses; None if it
+        does not exist. Pending code is written first, so the version is
+        current.
+        """
+        query = (db.session.query(Submission.id, Submission.user_id, Submission.assignment_id,
+                                  Submission.version, Submission.date_modified)
+                           .filter_by(id=submission_id))
+        row = query.first()
+        if row is not None and _flush_code(row.user_id, row.assignment_id):
+            row = query.first()
+        return row
+    
+    @staticmethod
+    def by_id(submission_id):
+        submission = Submission.query.get(submission_id)
+        if submission and _flush_code(submission.user_id, submission.assignment_id):
+            db.session.refresh(submission)
+        return submission
+        
+    @staticmethod
+    def save_code(user_id, assignment_id, code, assignment_version):
+        """
+        Records the student's latest code, which reaches the database shortly
+        afterwards through the `code_buffer`. Returns the new submission
+        version, and whether the student is working on the current version of
+        the assignment.
+        """
+        version = code_buffer.save(user_id, assignment_id, code)
+        return version, Assignment.is_version_correct(assignment_id, assignment_version)
+        
+    @staticmethod
+    def patch_code(user_id, assignment_id, base_version, patch, assignment_version):
+        """
+        Like `save_code`, but applies `patch` (see `code_buffer.apply_patch`)
+        to the code at submission version `base_version`. The version is None
+        if the submission has changed since then.
+        """
+        version = code_buffer.patch(user_id, assignment_id, base_version, patch)
+        return version, Assignment.is_version_correct(assignment_id, assignment_version)
+        
+    @staticmethod
+    def save_correct(user_id, assignment_id):
+        """
+        Marks the user's submission as correct, creating it if need be, and
+        returns it with its latest code.
+        """
+        submission = Submission.load(user_id, assignment_id)
+        submission.correct = True
+        save_changes()
         return submission
         
     
@@ -219,6 +586,15 @@ class Assignment(Base):
     course_id = Column(Integer(), ForeignKey('course.id'))
     version = Column(Integer(), default=0)
     
+    __table_args__ = (Index('ix_assignment_course_mode_name', 'course_id', 'mode', 'name'),
+                      # Keyset pagination of a course's summaries, see `summaries`
+                      Index('ix_assignment_course_id', 'course_id', 'id'),
+                      Index('ix_assignment_course_modified', 'course_id', 'date_modified', 'id'))
+    
+    # The light columns listed by `summaries`, leaving out the code and text
+    SUMMARY_COLUMNS = ('id', 'name', 'url', 'type', 'visibility', 'disabled', 'mode',
+                       'version', 'course_id', 'owner_id', 'date_modified')
+    
     def __str__(self):
         return '<Assignment {} for {}>'.format(self.id, self.course_id)
         
@@ -229,13 +605,40 @@ class Assignment(Base):
     def new(owner_id, course_id):
         assignment = Assignment(owner_id=owner_id, course_id=course_id)
         db.session.add(assignment)
-        db.session.commit()
+        save_changes()
         return assignment
     
     @staticmethod    
     def remove(assignment_id):
+        # A bulk delete skips the mapper events, so invalidate here
+        course_id = db.session.query(Assignment.course_id).filter_by(id=assignment_id).scalar()
         Assignment.query.filter_by(id=assignment_id).delete()
-        db.session.commit()
+        save_changes()
+        forget_course_tree(course_id)
+        
+    @staticmethod
+    def edit(assignment_id, presentation=None, name=None, on_run=None, on_step=None,
+             on_start=None, parsons=None, text_first=None):
+        """
+        Changes whichever of the given fields are not None; the version goes
+        up if anything changed, so that students see they are out of date.
+        """
+        assignment = Assignment.by_id(assignment_id)
+        changes = {'body': presentation, 'name': name, 'on_run': on_run,
+                   'on_step': on_step, 'on_start': on_start}
+        if parsons is not None:
+            changes['type'] = 'parsons' if parsons else 'normal'
+        if text_first is not None:
+            changes['visibility'] = 'hide' if text_first else 'visible'
+        changed = False
+        for column, value in changes.items():
+            if value is not None and getattr(assignment, column) != value:
+                setattr(assignment, column, value)
+                changed = True
+        if changed:
+            assignment.version = Assignment.version + 1
+        save_changes()
+        return assignment
         
     @staticmethod
     def by_course(course_id, exclude_builtins=True):
@@ -250,16 +653,102 @@ class Assignment(Base):
     def by_id(assignment_id):
         return Assignment.query.get(assignment_id)
     
+    @staticmethod
+    def summaries(course_id, since=None, after=None, limit=100):
+        """
+        One page of the course's assignments, with only the SUMMARY_COLUMNS;
+        like `by_course`, the builtin (maze) assignments are left out.
+        
+        Without `since`, pages go in id order and `after` is the last id
+        already seen. With `since`, only assignments modified at or after it
+        are listed, in (date_modified, id) order, and `after` is the last
+        (date_modified, id) already seen. date_modified only has a resolution
+        of seconds, so an assignment modified in the same second as `since`
+        is listed again rather than missed; within a listing, the cursor
+        keeps rows sharing a date_modified from repeating or being skipped.
+        Returns the rows and the `after` of the next page, which is None on
+        the last page.
+        """
+        columns = [getattr(Assignment, name) for name in Assignment.SUMMARY_COLUMNS]
+        query = (db.session.query(*columns).filter(Assignment.course_id == course_id)
+                                           .filter(Assignment.mode != 'maze'))
+        if since is None:
+            if after is not None:
+                query = query.filter(Assignment.id > after)
+            query = query.order_by(Assignment.id)
+        else:
+            query = query.filter(Assignment.date_modified >= since)
+            if after is not None:
+                modified, last_id = after
+                query = query.filter(or_(Assignment.date_modified > modified,
+                                         and_(Assignment.date_modified == modified,
+                                              Assignment.id > last_id)))
+            query = query.order_by(Assignment.date_modified, Assignment.id)
+        rows = query.limit(limit + 1).all()
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, (last.id if since is None else (last.date_modified, last.id))
+    
+    @staticmethod
+    def previous_summaries_after(course_id, after, limit=100):
+        """
+        For the `summaries` page (without `since`) that follows `after`: the
+        `after` of the page before it, which is None for the first page.
+        """
+        earlier = (db.session.query(Assignment.id).filter(Assignment.course_id == course_id)
+                                                  .filter(Assignment.mode != 'maze')
+                                                  .filter(Assignment.id <= after)
+                                                  .order_by(Assignment.id.desc())
+                                                  .limit(limit + 1)
+                                                  .all())
+        return earlier[-1].id if len(earlier) > limit else None
+    
+    @staticmethod
+    def validators(assignment_id):
+        """
+        The (id, version, date_modified) of an assignment, without its text
+        columns, for conditional responses; None if it does not exist.
+        """
+        return (db.session.query(Assignment.id, Assignment.version, Assignment.date_modified)
+                          .filter_by(id=assignment_id)
+                          .first())
+    
+    @staticmethod
+    def course_validators(course_id):
+        """
+        The (count, largest id, total version, latest date_modified) of a
+        course's assignments, which change whenever one is added, removed or
+        edited.
+        """
+        return (db.session.query(func.count(Assignment.id), func.max(Assignment.id),
+                                 func.sum(Assignment.version),
+                                 func.max(Assignment.date_modified))
+                          .filter_by(course_id=course_id)
+                          .one())
+        
+    @staticmethod
+    def is_version_correct(assignment_id, assignment_version):
+        """
+        Whether `assignment_version` is the assignment's current version. The
+        versions are cached briefly, since every keystroke asks.
+        """
+        key = int(assignment_id)
+        version = assignment_versions.get(key)
+        if version is None:
+            version = assignment_versions.set(key, (db.session.query(Assignment.version)
+                                                              .filter_by(id=key)
+                                                              .scalar()))
+        return version == assignment_version
+    
     @staticmethod    
     def by_builtin(type, id, owner_id, course_id):
-        assignment = Assignment.query.filter_by(course_id=course_id,
-                                                mode=type,
-                                                name=id).first()
-        if not assignment:
-            assignment = Assignment.new(owner_id, course_id)
-            assignment.mode = type
-            assignment.name = id
-            db.session.commit()
+        def create():
+            return Assignment(owner_id=owner_id, course_id=course_id,
+                              mode=type, name=id)
+        assignment, created = get_or_create(Assignment, create, course_id=course_id,
+                                            mode=type, name=id)
         return assignment
     @staticmethod
     def by_id_or_new(assignment_id, owner_id, course_id):
@@ -280,30 +769,117 @@ class Assignment(Base):
     def get_submission(self, user_id):
         return Submission.load(user_id, self.id)
         
+class Log(Base):
+    event = Column(String(255), default="")
+    action = Column(String(255), default="")
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'))
+    user_id = Column(Integer(), ForeignKey('user.id'))
+    
+    __table_args__ = (Index('ix_log_assignment_user', 'assignment_id', 'user_id'),)
+    
+    def __str__(self):
+        return '<Log {} for {}>'.format(self.event, self.user_id)
+    
+    @staticmethod
+    def new(event, action, assignment_id, user_id):
+        log = Log(event=event, action=action, 
+                  assignment_id=assignment_id, user_id=user_id)
+        db.session.add(log)
+        save_changes()
+        return log
+    
+    @staticmethod
+    def queue(event, action, assignment_id, user_id):
+        """
+        Record a log entry without waiting for the database; the row is
+        written in bulk by the `log_sink` shortly afterwards.
+        """
+        now = datetime.utcnow()
+        return log_sink.put({'event': event, 'action': action,
+                             'assignment_id': assignment_id, 'user_id': user_id,
+                             'date_created': now, 'date_modified': now})
+        
+log_sink = EventSink(app, db, Log.__table__,
+                     max_queue=app.config.get('LOG_SINK_MAX_QUEUE', 10000),
+                     batch_size=app.config.get('LOG_SINK_BATCH_SIZE', 200),
+                     interval=app.config.get('LOG_SINK_INTERVAL', 0.5))
+        
+def _load_submission_code(user_id, assignment_id):
+    submission = Submission.load(user_id, assignment_id)
+    return submission.id, submission.code, submission.version
+
+def _code_buffer_unit_of_work():
+    # On a connection of its own, the write would wait for the SQLite lock
+    # the unit of work holds once it has written, and would not be seen by
+    # the reads the unit of work has already begun
+    if in_unit_of_work():
+        return db.session, after_unit_of_work
+    return None
+
+code_buffer = CodeBuffer(app, db, Submission.__table__, _load_submission_code,
+                         quiet_period=app.config.get('SAVE_CODE_QUIET_PERIOD', 2.0),
+                         max_delay=app.config.get('SAVE_CODE_MAX_DELAY', 10.0),
+                         unit_of_work=_code_buffer_unit_of_work)
+
+def _flush_code(user_id, assignment_id):
+    # The code went to the primary, and outside a unit of work through a
+    # connection of its own, which the session's routing cannot see: reading
+    # it back from a replica, or in a transaction that began before it was
+    # committed, could miss it
+    if not code_buffer.flush(user_id, assignment_id):
+        return False
+    db.session().wrote = True
+    save_changes()
+    return True
+
+assignment_versions = TTLCache(max_entries=10000, ttl=5)
+# Rendered assignment pickers, keyed by (course_id, menu, return_url)
+assignment_pickers = TTLCache(max_entries=app.config.get('ASSIGNMENT_PICKER_CACHE_ENTRIES', 1024),
+                              ttl=app.config.get('ASSIGNMENT_PICKER_CACHE_TTL', 60),
+                              max_size=app.config.get('ASSIGNMENT_PICKER_CACHE_SIZE', 16 * 1024 * 1024),
+                              sizeof=utf8_size)
+
+def forget_course_tree(*course_ids):
+    """
+    Drop the cached pickers of these courses, after their assignments, groups
+    or memberships change.
+    """
+    course_ids = set(course_ids)
+    def forget():
+        assignment_pickers.discard_where(lambda key, value: key[0] in course_ids)
+    forget()
+    # Until they commit, other requests still see (and may cache) the old tree
+    if in_unit_of_work():
+        after_commit(forget)
+        
 class AssignmentGroup(Base):
     name = Column(String(255), default="Untitled")
     owner_id = Column(Integer(), ForeignKey('user.id'))
-    course_id = Column(Integer(), ForeignKey('course.id'))
+    course_id = Column(Integer(), ForeignKey('course.id'), index=True)
     
     @staticmethod    
     def new(owner_id, course_id):
         assignment_group = AssignmentGroup(owner_id=owner_id, course_id=course_id)
         db.session.add(assignment_group)
-        db.session.commit()
+        save_changes()
         return assignment_group
         
     @staticmethod    
     def remove(assignment_group_id):
+        # A bulk delete skips the mapper events, so invalidate here
+        course_id = (db.session.query(AssignmentGroup.course_id)
+                               .filter_by(id=assignment_group_id).scalar())
         AssignmentGroup.query.filter_by(id=assignment_group_id).delete()
         AssignmentGroupMembership.query.filter_by(assignment_group_id=assignment_group_id).delete()
-        db.session.commit()
+        save_changes()
+        forget_course_tree(course_id)
         
     @staticmethod
     def edit(assignment_group_id, name=None):
         assignment_group = AssignmentGroup.by_id(assignment_group_id)
         if name is not None:
             assignment_group.name = name
-        db.session.commit()
+        save_changes()
         return assignment_group
     
     @staticmethod
@@ -316,6 +892,45 @@ class AssignmentGroup(Base):
                                      .order_by(AssignmentGroup.name)
                                      .all())
     
+    @staticmethod
+    def course_tree(course_id):
+        """
+        Everything the assignment picker shows, in two queries however many
+        groups there are: the non-builtin assignments of the course, each of
+        its groups with their assignments in order, and the ungrouped
+        assignments (the same lists as `Assignment.by_course`,
+        `get_assignments` and `get_ungrouped_assignments`).
+        
+        The groups are read on their own because a group need not have any
+        assignments, and the ungrouped assignments have no group: one
+        statement would need a FULL OUTER JOIN, which neither SQLite nor
+        MySQL has, or a UNION of these same two selects. There is no
+        relationship from a group to its assignments to eager-load either.
+        """
+        groups = AssignmentGroup.by_course(course_id)
+        members = dict((group.id, []) for group in groups)
+        course_groups = db.session.query(AssignmentGroup.id).filter_by(course_id=course_id)
+        rows = (db.session.query(Assignment, AssignmentGroupMembership.assignment_group_id)
+                          .outerjoin(AssignmentGroupMembership,
+                                     AssignmentGroupMembership.assignment_id == Assignment.id)
+                          .filter(or_(Assignment.course_id == course_id,
+                                      AssignmentGroupMembership.assignment_group_id.in_(course_groups)))
+                          .order_by(AssignmentGroupMembership.position, Assignment.id)
+                          .all())
+        assignments, strays, seen = [], [], set()
+        for assignment, group_id in rows:
+            if group_id in members:
+                members[group_id].append(assignment)
+            elif group_id is None:
+                strays.append(assignment)
+            if (assignment.course_id == course_id and assignment.mode != 'maze'
+                    and assignment.id not in seen):
+                seen.add(assignment.id)
+                assignments.append(assignment)
+        assignments.sort(key=lambda assignment: assignment.id)
+        strays.sort(key=lambda assignment: assignment.id)
+        return assignments, [(group, members[group.id]) for group in groups], strays
+    
     @staticmethod
     def get_ungrouped_assignments(course_id):
         return (Assignment.query
@@ -334,9 +949,12 @@ class AssignmentGroup(Base):
         
 class AssignmentGroupMembership(Base):
     assignment_group_id = Column(Integer(), ForeignKey('assignmentgroup.id'))
-    assignment_id = Column(Integer(), ForeignKey('assignment.id'))
+    assignment_id = Column(Integer(), ForeignKey('assignment.id'), index=True)
     position = Column(Integer())
     
+    __table_args__ = (Index('ix_assignmentgroupmembership_group_position', 
+                            'assignment_group_id', 'position'),)
+    
     @staticmethod
     def move_assignment(assignment_id, new_group_id):
         membership = (AssignmentGroupMembership.query
@@ -349,5 +967,58 @@ class AssignmentGroupMembership(Base):
             db.session.add(membership)
         else:
             membership.assignment_group_id = new_group_id
-        db.session.commit()
+        save_changes()
         return membership
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _invalidate_user_identity(mapper, connection, target):
+    _forget_identity('user', target.id)
+
+@event.listens_for(Authentication, 'after_update')
+@event.listens_for(Authentication, 'after_delete')
+def _invalidate_authentication_identity(mapper, connection, target):
+    identity_cache.discard(('user', target.type, target.value))
+    _forget_identity('user', target.user_id)
+
+@event.listens_for(Course, 'after_update')
+@event.listens_for(Course, 'after_delete')
+def _invalidate_course_identity(mapper, connection, target):
+    _forget_identity('course', target.id)
+
+@event.listens_for(Role, 'after_insert')
+@event.listens_for(Role, 'after_update')
+@event.listens_for(Role, 'after_delete')
+def _invalidate_role_names(mapper, connection, target):
+    if has_app_context() and hasattr(g, 'role_names_by_user'):
+        g.role_names_by_user.pop(target.user_id, None)
+
+@event.listens_for(Assignment, 'after_update')
+@event.listens_for(Assignment, 'after_delete')
+def _invalidate_assignment_version(mapper, connection, target):
+    assignment_versions.discard(target.id)
+
+@event.listens_for(Assignment, 'after_insert')
+@event.listens_for(Assignment, 'after_update')
+@event.listens_for(Assignment, 'after_delete')
+@event.listens_for(AssignmentGroup, 'after_insert')
+@event.listens_for(AssignmentGroup, 'after_update')
+@event.listens_for(AssignmentGroup, 'after_delete')
+def _invalidate_course_tree(mapper, connection, target):
+    # Moving between courses changes both
+    history = inspect(target).attrs.course_id.history
+    forget_course_tree(target.course_id, *(history.deleted or ()))
+
+@event.listens_for(AssignmentGroupMembership, 'after_insert')
+@event.listens_for(AssignmentGroupMembership, 'after_update')
+@event.listens_for(AssignmentGroupMembership, 'after_delete')
+def _invalidate_membership_course_tree(mapper, connection, target):
+    history = inspect(target).attrs.assignment_group_id.history
+    group_ids = [target.assignment_group_id] + list(history.deleted or ())
+    groups = AssignmentGroup.__table__
+    assignments = Assignment.__table__
+    course_ids = [row[0] for row in connection.execute(
+                  select([groups.c.course_id]).where(groups.c.id.in_(group_ids)))]
+    course_ids.append(connection.execute(select([assignments.c.course_id])
+                                         .where(assignments.c.id == target.assignment_id)).scalar())
+    forget_course_tree(*course_ids)
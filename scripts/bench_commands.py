@@ -0,0 +1,702 @@
+from flask_script import Command, Option
+from main import app
+import os
+import timeit
+
+try:
+    from urllib.parse import urlencode, urlsplit
+    from urllib.request import build_opener, HTTPCookieProcessor
+    from urllib.error import HTTPError
+    from http.cookiejar import CookieJar
+except ImportError:
+    from urllib import urlencode
+    from urlparse import urlsplit
+    from urllib2 import build_opener, HTTPCookieProcessor, HTTPError
+    from cookielib import CookieJar
+
+
+def use_scratch_database(database, fresh=True):
+    '''
+    Point the application at the SQLite file `database`, instead of the
+    configured database, and create the tables in it; with `fresh`, any
+    earlier copy is removed first.
+    '''
+    from models.models import db
+    database = os.path.abspath(database)
+    if fresh:
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(database + suffix):
+                os.remove(database + suffix)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+    db.create_all()
+    return database
+
+
+class BenchHighlight(Command):
+    """Compares per-request cost of highlighting grade feedback, before and after caching"""
+    option_list = (
+        Option('--repeat', '-r', dest='repeat', type=int, default=200),
+        Option('--lines', '-l', dest='lines', type=int, default=60),
+    )
+
+    def run(self, repeat, lines, **kwargs):
+        from pygments import highlight
+        from pygments.lexers import PythonLexer
+        from pygments.formatters import HtmlFormatter
+        from controllers.highlighting import highlight_python, highlight_cache
+
+        code = "\n".join("total = total + {0}  # step {0}".format(i) for i in range(lines))
+        def uncached():
+            highlight(code, PythonLexer(), HtmlFormatter())
+        def cached():
+            highlight_python(code)
+        highlight_cache.clear()
+        first = timeit.timeit(cached, number=1)
+        results = [("fresh lexer/formatter", timeit.timeit(uncached, number=repeat) / repeat),
+                   ("cache miss", first),
+                   ("cache hit", timeit.timeit(cached, number=repeat) / repeat)]
+        print("Highlighting {} lines of code, {} repetitions".format(lines, repeat))
+        for name, seconds in results:
+            print("{:>24}: {:10.1f} us/request".format(name, seconds * 1e6))
+
+
+class BenchLookups(Command):
+    """Times the LTI lookup hot paths on a generated SQLite database, with and without indexes"""
+    option_list = (
+        Option('--submissions', '-n', dest='submissions', type=int, default=1000000),
+        Option('--lookups', '-l', dest='lookups', type=int, default=200),
+        Option('--database', '-d', dest='database', default='database/bench_lookups.db'),
+    )
+
+    def run(self, submissions, lookups, database, **kwargs):
+        import random
+        from sqlalchemy import create_engine
+        from models.models import Submission, Authentication
+        from scripts.db_commands import bulk_insert
+
+        engine = create_engine('sqlite:///' + database)
+        tables = [Submission.__table__, Authentication.__table__]
+        for table in tables:
+            table.drop(engine, checkfirst=True)
+            table.create(engine)
+            for index in table.indexes:
+                index.drop(engine)
+
+        assignments = 50
+        users = max(1, submissions // assignments)
+        print("Generating {} submissions for {} users".format(submissions, users))
+        with engine.begin() as connection:
+            bulk_insert(connection, Submission.__table__,
+                        ({'assignment_id': i % assignments, 'user_id': i // assignments,
+                          'code': '', 'version': 0} for i in range(submissions)))
+            bulk_insert(connection, Authentication.__table__,
+                        ({'type': 'canvas', 'value': 'lti-user-{}'.format(i), 'user_id': i}
+                         for i in range(users)))
+
+        generator = random.Random(0)
+        keys = [(generator.randrange(assignments), generator.randrange(users))
+                for _ in range(lookups)]
+        submission_table, authentication_table = tables
+        def find_submissions(connection):
+            for assignment_id, user_id in keys:
+                connection.execute(submission_table.select()
+                                   .where(submission_table.c.assignment_id == assignment_id)
+                                   .where(submission_table.c.user_id == user_id)).first()
+        def find_authentications(connection):
+            for _, user_id in keys:
+                connection.execute(authentication_table.select()
+                                   .where(authentication_table.c.type == 'canvas')
+                                   .where(authentication_table.c.value == 'lti-user-{}'.format(user_id))).first()
+
+        for label in ("without indexes", "with indexes"):
+            if label == "with indexes":
+                for table in tables:
+                    for index in table.indexes:
+                        index.create(engine)
+            with engine.connect() as connection:
+                for name, lookup in (("Submission.load", find_submissions),
+                                     ("User.from_lti", find_authentications)):
+                    seconds = timeit.timeit(lambda: lookup(connection), number=1)
+                    print("{:>16} {:>16}: {:10.3f} ms/lookup".format(
+                          name, label, seconds * 1000 / lookups))
+
+
+class StressLaunches(Command):
+    """Launches many first-time users at once and checks that nothing was created twice"""
+    option_list = (
+        Option('--users', '-u', dest='users', type=int, default=500),
+        Option('--launches', '-l', dest='launches', type=int, default=2,
+               help="Concurrent launches per user"),
+        Option('--threads', '-t', dest='threads', type=int, default=None,
+               help="Launches handled at a time, as by serve.py's pool (SERVE_THREADS)"),
+        Option('--database', '-d', dest='database', default='database/stress_launches.db'),
+    )
+
+    def run(self, users, launches, threads, database, **kwargs):
+        import threading
+        from uuid import uuid4
+        from collections import deque
+        from sqlalchemy import func
+        from models.models import (db, User, Course, Assignment, Submission,
+                                   Authentication)
+
+        use_scratch_database(database)
+        run_id = uuid4().hex[:8]
+        context_id = 'stress-course-' + run_id
+        with app.app_context():
+            # Users are matched by email first, so every user needs their own
+            owner = User.from_lti('stress', 'owner-' + run_id, 'owner-{}@example.edu'.format(run_id),
+                                  'Stress', 'Owner')
+            assignment = Assignment.by_builtin('stress', run_id, owner.id, None)
+            assignment_id = assignment.id
+            db.session.remove()
+
+        start = threading.Event()
+        errors = []
+        def launch(index):
+            start.wait()
+            with app.app_context():
+                try:
+                    user = User.from_lti('stress', '{}-{}'.format(run_id, index),
+                                         '{}-{}@example.edu'.format(run_id, index),
+                                         'Stress', str(index))
+                    course = Course.from_lti('stress', context_id, 'Stress Course', user.id)
+                    Submission.load(user.id, assignment_id)
+                except Exception as e:
+                    errors.append(repr(e))
+                finally:
+                    db.session.remove()
+        # All arrive at once, and wait for a thread like requests for a
+        # server's; a user's launches are next to each other, so they race
+        pending = deque(index for index in range(users) for _ in range(launches))
+        total = len(pending)
+        def serve():
+            start.wait()
+            while True:
+                try:
+                    index = pending.popleft()
+                except IndexError:
+                    return
+                launch(index)
+        threads = threads or app.config.get('SERVE_THREADS', 8)
+        workers = [threading.Thread(target=serve) for _ in range(min(threads, total))]
+        for worker in workers:
+            worker.start()
+        start.set()
+        for worker in workers:
+            worker.join()
+
+        with app.app_context():
+            authentications = (db.session.query(Authentication.value, func.count(Authentication.id))
+                                         .filter(Authentication.value.like(run_id + '-%'))
+                                         .group_by(Authentication.value).all())
+            courses = Course.query.filter_by(external_id=context_id).count()
+            submissions = (db.session.query(Submission.user_id, func.count(Submission.id))
+                                     .filter_by(assignment_id=assignment_id)
+                                     .group_by(Submission.user_id).all())
+            db.session.remove()
+        duplicated_users = sum(1 for _, count in authentications if count > 1)
+        duplicated_submissions = sum(1 for _, count in submissions if count > 1)
+        print("{} launches by {} users on {} threads, {} errors".format(total, users, len(workers),
+                                                                         len(errors)))
+        for error in sorted(set(errors)):
+            print("  " + error)
+        print("Users: {} ({} duplicated)".format(len(authentications), duplicated_users))
+        print("Courses: {} (expected 1)".format(courses))
+        print("Submissions: {} ({} duplicated)".format(len(submissions), duplicated_submissions))
+        if errors or duplicated_users or duplicated_submissions or courses != 1:
+            raise SystemExit(1)
+
+
+class BenchRoles(Command):
+    """Times session requests that check LTI roles, with the old substring check and with the per-launch bitmask"""
+    option_list = (
+        Option('--requests', '-n', dest='requests', type=int, default=2000,
+               help="Requests per endpoint, role and check"),
+        Option('--database', '-d', dest='database', default='database/bench_roles.db'),
+    )
+
+    def run(self, requests, database, **kwargs):
+        from uuid import uuid4
+        from flask import session
+        from models.models import db, User, Assignment, Submission, Authentication
+        from controllers import lti as lti_controller
+        from scripts.fake_lms import FakeLMS
+
+        if 'lti_assignments' not in app.blueprints:
+            app.register_blueprint(lti_controller.lti_assignments)
+        use_scratch_database(database)
+        run_id = uuid4().hex[:8]
+        with app.app_context():
+            owner = User.from_lti('bench', 'owner-' + run_id, '', 'Bench', 'Owner')
+            assignment_id = Assignment.by_builtin('bench', run_id, owner.id, None).id
+            db.session.remove()
+        lms = FakeLMS(app)
+        launch_url = 'http://localhost/lti_assignments/index?assignment_id={}'.format(assignment_id)
+        clients = {}
+        for name, roles in (('student', "Learner,urn:lti:instrole:ims/lis/Student"),
+                            ('instructor', "Instructor,urn:lti:instrole:ims/lis/Instructor,"
+                                           "urn:lti:sysrole:ims/lis/User")):
+            client = clients[name] = app.test_client()
+            response = client.post(launch_url, data=lms.launch_params(
+                launch_url, '{}-{}'.format(run_id, name), run_id, assignment_id, roles=roles))
+            if response.status_code != 200:
+                raise SystemExit("Could not launch as the {}: {}".format(name, response.status_code))
+        with app.app_context():
+            student = Authentication.query.filter_by(value='student-{}-student'.format(run_id)).one()
+            submission_id = Submission.load(student.user_id, assignment_id).id
+            db.session.remove()
+        # Both read the student's submission: the instructor is let in by the
+        # role check, the student by owning it
+        url = '/lti_assignments/get_submission_code?submission_id={}'.format(submission_id)
+
+        # As before the bitmask: every check scanned the raw roles for substrings
+        def substring_check(given_roles):
+            ROLES = ["urn:lti:role:ims/lis/TeachingAssistant",
+                     "Instructor", "ContentDeveloper",
+                     "urn:lti:role:ims/lis/Instructor",
+                     "urn:lti:role:ims/lis/ContentDeveloper"]
+            return any(role for role in ROLES if role in given_roles)
+        original = (lti_controller.lti_role_mask, User.__dict__['is_lti_instructor'])
+        checks = {'substring': (lambda: session.get('roles', ''), staticmethod(substring_check)),
+                  'bitmask': original}
+        timings = dict(((check, name), []) for check in checks for name in clients)
+        try:
+            # Alternated in rounds, so that drift in the machine's speed
+            # affects both checks alike
+            for _ in range(requests // 100 or 1):
+                for check, (role_mask, is_lti_instructor) in sorted(checks.items()):
+                    lti_controller.lti_role_mask = role_mask
+                    User.is_lti_instructor = is_lti_instructor
+                    for name, client in sorted(clients.items()):
+                        for _ in range(min(100, requests)):
+                            started = timeit.default_timer()
+                            response = client.get(url)
+                            timings[check, name].append(timeit.default_timer() - started)
+                            if 'permissions' in response.get_data(as_text=True):
+                                raise SystemExit("The {} was refused".format(name))
+        finally:
+            lti_controller.lti_role_mask, User.is_lti_instructor = original
+        print("get_submission_code, {} requests each".format(len(timings['bitmask', 'student'])))
+        for name in sorted(clients):
+            medians = {}
+            for check in checks:
+                ordered = sorted(timings[check, name])
+                medians[check] = percentile(ordered, 0.5)
+            print("{:>12}: substring p50 {:.3f} ms, bitmask p50 {:.3f} ms ({:+.3f} ms)".format(
+                  name, medians['substring'] * 1e3, medians['bitmask'] * 1e3,
+                  (medians['bitmask'] - medians['substring']) * 1e3))
+
+
+class BenchLogging(Command):
+    """Times LTI launches, which log the student's IP address, with interaction logging off, synchronous and queued"""
+    option_list = (
+        Option('--launches', '-n', dest='launches', type=int, default=300,
+               help="Launches per mode"),
+        Option('--database', '-d', dest='database', default='database/bench_logging.db'),
+    )
+
+    def run(self, launches, database, **kwargs):
+        import logging
+        import tempfile
+        from uuid import uuid4
+        from models.models import db, User, Assignment
+        from controllers.lti import lti_assignments
+        from scripts.fake_lms import FakeLMS
+        from interaction_logger import (JsonLinesFormatter, QueueHandler, QueueListener,
+                                        BatchRotatingFileHandler)
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+
+        if 'lti_assignments' not in app.blueprints:
+            app.register_blueprint(lti_assignments)
+        use_scratch_database(database)
+        run_id = uuid4().hex[:8]
+        with app.app_context():
+            owner = User.from_lti('bench', 'owner-' + run_id, '', 'Bench', 'Owner')
+            assignment_id = Assignment.by_builtin('bench', run_id, owner.id, None).id
+            db.session.remove()
+        lms = FakeLMS(app)
+        launch_url = 'http://localhost/lti_assignments/index?assignment_id={}'.format(assignment_id)
+        users = ['{}-{}'.format(run_id, index) for index in range(launches)]
+        def launch(user):
+            # A new session, so the launch logs the IP address again
+            response = app.test_client().post(launch_url, data=lms.launch_params(
+                launch_url, user, run_id, assignment_id))
+            if response.status_code != 200:
+                raise SystemExit("Launch failed: {}".format(response.status_code))
+        # Every user's first launch creates rows, which is not what is measured
+        for user in users:
+            launch(user)
+
+        directory = tempfile.mkdtemp()
+        logger = logging.getLogger('ExternalInteractions')
+        saved = (logger.handlers[:], logger.level, logger.propagate)
+        listeners = []
+        def configure(mode):
+            logger.handlers = []
+            logger.propagate = False
+            logger.setLevel(logging.CRITICAL if mode == 'off' else logging.INFO)
+            if mode == 'off':
+                return
+            file_handler = BatchRotatingFileHandler(os.path.join(directory, mode + '.jsonl'))
+            file_handler.setFormatter(JsonLinesFormatter())
+            if mode == 'sync':
+                logger.addHandler(file_handler)
+            else:
+                listener = QueueListener(queue.Queue(), {logger.name: [file_handler]})
+                listener.start()
+                listeners.append(listener)
+                logger.addHandler(QueueHandler(listener.queue, listener))
+        modes = ('off', 'sync', 'queued')
+        timings = dict((mode, []) for mode in modes)
+        try:
+            # Alternated in rounds, so that drift in the machine's speed
+            # affects every mode alike
+            for round_start in range(0, launches, 50):
+                for mode in modes:
+                    configure(mode)
+                    for user in users[round_start:round_start + 50]:
+                        started = timeit.default_timer()
+                        launch(user)
+                        timings[mode].append(timeit.default_timer() - started)
+        finally:
+            for listener in listeners:
+                listener.stop()
+            logger.handlers, logger.level, logger.propagate = saved
+        print("{} launches per mode".format(launches))
+        off = percentile(sorted(timings['off']), 0.5)
+        for mode in modes:
+            ordered = sorted(timings[mode])
+            path = os.path.join(directory, mode + '.jsonl')
+            logged = sum(1 for line in open(path)) if os.path.exists(path) else 0
+            print("{:>8}: p50 {:.3f} ms ({:+.3f} ms), p95 {:.3f} ms, {} events logged".format(
+                  mode, percentile(ordered, 0.5) * 1e3, (percentile(ordered, 0.5) - off) * 1e3,
+                  percentile(ordered, 0.95) * 1e3, logged))
+
+
+class ProfileStartup(Command):
+    """Times the application's start-up imports in a fresh interpreter, per package and per module"""
+    option_list = (
+        Option('--role', '-r', dest='role', default=None, choices=('lti', 'admin', 'all'),
+               help="The WORKER_ROLE to start as"),
+        Option('--limit', '-l', dest='limit', type=int, default=20),
+        Option('--target', '-t', dest='target', default='main'),
+    )
+
+    def run(self, role, limit, target, **kwargs):
+        import sys
+        import json
+        import tempfile
+        import subprocess
+
+        environment = dict(os.environ)
+        if role:
+            environment['WORKER_ROLE'] = role
+        handle, output = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        try:
+            # This process has imported everything already
+            subprocess.check_call([sys.executable, '-m', 'scripts.startup_profile', target, output],
+                                  env=environment, cwd=app.root_path)
+            with open(output) as output_file:
+                profile = json.load(output_file)
+        finally:
+            os.remove(output)
+
+        modules = profile['modules']
+        packages = {}
+        for name, cumulative, own in modules:
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0.0) + own
+        print("Importing {} as role {}: {:.0f} ms, {} modules".format(
+              target, role or environment.get('WORKER_ROLE', 'all'),
+              profile['total'] * 1000, len(modules)))
+        print("{:>32} {:>10}".format('package', 'self ms'))
+        for package, own in sorted(packages.items(), key=lambda item: -item[1])[:limit]:
+            print("{:>32} {:>10.1f}".format(package, own * 1000))
+        print("{:>32} {:>10} {:>10}".format('module', 'total ms', 'self ms'))
+        for name, cumulative, own in sorted(modules, key=lambda module: -module[1])[:limit]:
+            print("{:>32} {:>10.1f} {:>10.1f}".format(name, cumulative * 1000, own * 1000))
+
+
+class HttpClient(object):
+    """Just enough of Flask's test client, over real HTTP with cookies, to benchmark a running server"""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def post(self, url, data):
+        if url.startswith('/'):
+            url = self.base_url + url
+        try:
+            response = self.opener.open(url, urlencode(data).encode('utf-8'))
+            response.read()
+            status_code = response.getcode()
+        except HTTPError as error:
+            error.read()
+            status_code = error.code
+        return HttpResponse(status_code)
+
+
+class HttpResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+def percentile(ordered, fraction):
+    '''
+    Nearest-rank percentile of an already sorted list.
+    '''
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Bench(Command):
+    """Drives simulated student sessions through the LTI endpoints and reports latency per endpoint"""
+    option_list = (
+        Option('--students', '-s', dest='students', type=int, default=100),
+        Option('--concurrency', '-c', dest='concurrency', type=int, default=10),
+        Option('--polls', '-p', dest='polls', type=int, default=20,
+               help="save_code/save_events rounds per student"),
+        Option('--save-baseline', dest='save_baseline', default=None,
+               help="Write the results to this JSON file"),
+        Option('--baseline', '-b', dest='baseline', default=None,
+               help="Compare with the results in this JSON file"),
+        Option('--tolerance', '-t', dest='tolerance', type=float, default=0.2,
+               help="Allowed fractional slowdown of p95 before it counts as a regression"),
+        Option('--eager-commits', dest='eager_commits', action='store_true', default=False,
+               help="Commit as each row is created, instead of once per request"),
+        Option('--url', '-u', dest='url', default=None,
+               help="Benchmark the server running at this URL (e.g., started by serve.py) "
+                    "instead of the application in this process"),
+        Option('--database', '-d', dest='database', default='database/bench.db',
+               help="The scratch SQLite database to use; with --url, the server must be "
+                    "serving it too (serve.py --database)"),
+        Option('--configured-database', dest='configured_database', action='store_true',
+               default=False, help="Use the configured database, leaving the rows behind"),
+    )
+
+    def run(self, students, concurrency, polls, save_baseline, baseline, tolerance,
+            eager_commits, url, database, configured_database, **kwargs):
+        import json
+        import threading
+        from uuid import uuid4
+        from models.models import db, User, Assignment
+        from controllers import profiling
+        from controllers.lti import lti_assignments
+        from controllers.grading import grade_dispatcher
+        from scripts.fake_lms import FakeLMS
+
+        if 'lti_assignments' not in app.blueprints:
+            app.register_blueprint(lti_assignments)
+        if eager_commits:
+            app.config['UNIT_OF_WORK'] = False
+        # Errors are answered with a 500 and counted, as a real server would,
+        # rather than raised into the benchmark's threads
+        app.config['PROPAGATE_EXCEPTIONS'] = False
+        if 'outcome_stub' not in app.blueprints:
+            print("Warning: GRADE_OUTCOME_STUB is off, so grades have nowhere to go")
+        if configured_database:
+            db.create_all()
+        else:
+            # A running server already has the file open
+            database = use_scratch_database(database, fresh=not url)
+            print("Using the scratch database {}".format(database))
+        run_id = uuid4().hex[:8]
+        with app.app_context():
+            owner = User.from_lti('bench', 'owner-' + run_id, '', 'Bench', 'Owner')
+            assignment_id = Assignment.by_builtin('bench', run_id, owner.id, None).id
+            db.session.remove()
+        if url:
+            # Grades go to the server's own /outcome_stub/
+            address = urlsplit(url)
+            lms = FakeLMS(app, host=address.hostname, port=address.port or 80)
+        else:
+            lms = FakeLMS(app)
+            lms.start()
+        base_url = url.rstrip('/') if url else 'http://localhost'
+
+        timings, statuses = {}, {}
+        lock = threading.Lock()
+        def timed(client, endpoint, url, data):
+            started = timeit.default_timer()
+            try:
+                status = client.post(url, data=data).status_code
+            except Exception as error:
+                # A refused or dropped connection is a failed request too,
+                # rather than the end of this thread's students
+                status = type(error).__name__
+            elapsed = timeit.default_timer() - started
+            with lock:
+                timings.setdefault(endpoint, []).append(elapsed)
+                statuses.setdefault(endpoint, {}).setdefault(status, 0)
+                statuses[endpoint][status] += 1
+
+        def student(index):
+            client = HttpClient(url) if url else app.test_client()
+            user = '{}-{}'.format(run_id, index)
+            launch_url = '{}/lti_assignments/index?assignment_id={}'.format(base_url, assignment_id)
+            timed(client, 'index', launch_url,
+                  lms.launch_params(launch_url, user, run_id, assignment_id))
+            code = ''
+            for poll in range(polls):
+                code += 'print({})\n'.format(poll)
+                timed(client, 'save_code', '/lti_assignments/save_code',
+                      {'question_id': assignment_id, 'code': code, 'version': -1})
+                timed(client, 'save_events', '/lti_assignments/save_events',
+                      {'question_id': assignment_id, 'event': 'editor', 'action': 'change'})
+            timed(client, 'save_correct', '/lti_assignments/save_correct',
+                  {'question_id': assignment_id, 'status': '1',
+                   'lis_result_sourcedid': 'sourcedid-{}-{}'.format(user, assignment_id)})
+
+        remaining = list(range(students))
+        def worker():
+            while True:
+                with lock:
+                    if not remaining:
+                        return
+                    index = remaining.pop()
+                student(index)
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        started = timeit.default_timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = timeit.default_timer() - started
+        grade_dispatcher.stop()
+        lms.stop()
+
+        # Commits are what cost an fsync (or, in WAL mode, a WAL append); only
+        # known for requests handled in this process
+        profiles = {} if url else profiling.endpoint_snapshot()
+        results = {}
+        for endpoint, seconds in timings.items():
+            seconds.sort()
+            profile = profiles.get('lti_assignments.' + endpoint)
+            results[endpoint] = {'requests': len(seconds),
+                                 'commits': (profile['commits'] / float(len(seconds))
+                                             if profile else None),
+                                 'throughput': len(seconds) / elapsed,
+                                 'p50': percentile(seconds, 0.50),
+                                 'p95': percentile(seconds, 0.95),
+                                 'p99': percentile(seconds, 0.99),
+                                 'statuses': dict((str(status), count) for status, count
+                                                  in statuses[endpoint].items())}
+        total = sum(result['requests'] for result in results.values())
+        print("{} students, {} at a time: {} requests in {:.1f} s ({:.1f} requests/s)".format(
+              students, concurrency, total, elapsed, total / elapsed))
+        print("{:>14} {:>9} {:>9} {:>9} {:>9} {:>9} {:>11}  {}".format(
+              'endpoint', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'commits/req',
+              'statuses'))
+        for endpoint, result in sorted(results.items()):
+            commits = '-' if result['commits'] is None else '{:.2f}'.format(result['commits'])
+            print("{:>14} {:>9} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>11}  {}".format(
+                  endpoint, result['requests'], result['throughput'], result['p50'] * 1000,
+                  result['p95'] * 1000, result['p99'] * 1000, commits,
+                  ', '.join('{}: {}'.format(status, count)
+                            for status, count in sorted(result['statuses'].items()))))
+        print("Grades: {}".format(grade_dispatcher.stats()))
+
+        if save_baseline:
+            with open(save_baseline, 'w') as baseline_file:
+                json.dump({'students': students, 'concurrency': concurrency, 'polls': polls,
+                           'unit_of_work': app.config.get('UNIT_OF_WORK', True), 'url': url,
+                           'endpoints': results}, baseline_file, indent=2, sort_keys=True)
+            print("Saved baseline to {}".format(save_baseline))
+        regressions = []
+        if baseline:
+            with open(baseline) as baseline_file:
+                previous = json.load(baseline_file)['endpoints']
+            for endpoint, result in sorted(results.items()):
+                if endpoint not in previous:
+                    continue
+                before, after = previous[endpoint]['p95'], result['p95']
+                change = (after - before) / before if before else 0.0
+                print("{:>14}: p95 {:.2f} ms -> {:.2f} ms ({:+.0%})".format(
+                      endpoint, before * 1000, after * 1000, change))
+                if change > tolerance:
+                    regressions.append(endpoint)
+            if regressions:
+                print("Regressed: {}".format(', '.join(regressions)))
+        failed = [endpoint for endpoint, result in sorted(results.items())
+                  if any(not (status.isdigit() and 200 <= int(status) < 300)
+                         for status in result['statuses'])]
+        if failed:
+            print("Failed requests: {}".format(', '.join(failed)))
+        if regressions or failed:
+            raise SystemExit(1)
+
+
+class BenchWrites(Command):
+    """Compares concurrent save_code/save_events write throughput on SQLite, with default and tuned settings"""
+    option_list = (
+        Option('--workers', '-w', dest='workers', type=int, default=8),
+        Option('--writes', '-n', dest='writes', type=int, default=200,
+               help="Transactions per worker"),
+        Option('--database', '-d', dest='database', default='database/bench_writes.db'),
+    )
+
+    def run(self, workers, writes, database, **kwargs):
+        import threading
+        from datetime import datetime
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import QueuePool
+        from sqlalchemy.exc import OperationalError
+        from models.models import Submission, Log
+        from models.engine import tune_sqlite
+
+        settings = (("default", None),
+                    ("tuned", app.config.get('SQLITE_PRAGMAS')))
+        print("{} workers, {} transactions each".format(workers, writes))
+        for label, pragmas in settings:
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                if os.path.exists(database + suffix):
+                    os.remove(database + suffix)
+            # pysqlite's own 5 second lock timeout applies either way
+            engine = create_engine('sqlite:///' + database, poolclass=QueuePool,
+                                   pool_size=workers, connect_args={'check_same_thread': False})
+            if pragmas:
+                tune_sqlite(engine, pragmas)
+            submissions, logs = Submission.__table__, Log.__table__
+            for table in (submissions, logs):
+                table.create(engine)
+            with engine.begin() as connection:
+                connection.execute(submissions.insert(),
+                                   [{'id': worker + 1, 'user_id': worker, 'assignment_id': 1,
+                                     'code': '', 'version': 0} for worker in range(workers)])
+
+            start = threading.Event()
+            failures = []
+            def worker(index):
+                start.wait()
+                for write in range(writes):
+                    now = datetime.utcnow()
+                    try:
+                        with engine.begin() as connection:
+                            connection.execute(logs.insert(), {'event': 'editor', 'action': 'change',
+                                                               'assignment_id': 1, 'user_id': index,
+                                                               'date_created': now, 'date_modified': now})
+                            connection.execute(submissions.update()
+                                               .where(submissions.c.id == index + 1)
+                                               .values(code='print({})'.format(write),
+                                                       version=submissions.c.version + 1))
+                    except OperationalError as e:
+                        failures.append(str(e.orig))
+            threads = [threading.Thread(target=worker, args=(index,)) for index in range(workers)]
+            for thread in threads:
+                thread.start()
+            started = timeit.default_timer()
+            start.set()
+            for thread in threads:
+                thread.join()
+            elapsed = timeit.default_timer() - started
+            engine.dispose()
+            committed = workers * writes - len(failures)
+            print("{:>8}: {:8.1f} transactions/s, {} failed{}".format(
+                  label, committed / elapsed, len(failures),
+                  " ({})".format(failures[0]) if failures else ""))
@@ -20,13 +20,43 @@ class ResetDB(Command):
         db.drop_all()
         db.create_all()
         
+def bulk_insert(connection, table, rows, batch_size=10000):
+    """Inserts an iterable of row dictionaries a batch at a time; returns how many"""
+    batch, count = [], 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            connection.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
 class PopulateDB(Command):
     option_list = (
         Option('--file', '-f', dest='user_data_file', default='scripts/user_data.csv'),
+        Option('--scale', dest='scale', action='store_true', default=False,
+               help="Generate a large synthetic dataset instead"),
+        Option('--seed', dest='seed', type=int, default=0),
+        Option('--courses', dest='courses', type=int, default=200),
+        Option('--users', dest='users', type=int, default=200000),
+        Option('--assignments', dest='assignments', type=int, default=40,
+               help="Assignments per course"),
+        Option('--groups', dest='groups', type=int, default=8,
+               help="Assignment groups per course"),
+        Option('--submissions', dest='submissions', type=int, default=10,
+               help="Submissions per user"),
+        Option('--logs', dest='logs', type=int, default=2,
+               help="Logs per submission"),
+        Option('--batch-size', dest='batch_size', type=int, default=10000),
     )
     
     """Fills in predefined data into DB"""
-    def run(self, user_data_file, **kwargs):
+    def run(self, user_data_file, scale, **kwargs):
+        if scale:
+            return self.populate_scale(**kwargs)
         from models.models import Role, User, Course, Assignment, CourseAssignment, AssignmentGroup, AssignmentGroupMembership
         
         print("Adding Admin")
@@ -96,7 +126,266 @@ class PopulateDB(Command):
         
         db.session.commit()
         print("Complete")
+    
+    def populate_scale(self, seed, courses, users, assignments, groups, submissions, logs,
+                       batch_size, **kwargs):
+        """
+        Streams generated rows into the database with bulk inserts. Ids are
+        assigned here, after any existing rows, so that every table can be
+        generated without reading another back; the same seed on an empty
+        database always produces the same data.
+        """
+        import time
+        import hashlib
+        from sqlalchemy import func, select
+        from models.models import (User, Role, Authentication, Course, Assignment,
+                                   AssignmentGroup, AssignmentGroupMembership,
+                                   Submission, Log)
+        db.create_all()
+        submissions = min(submissions, assignments)
+        groups = min(groups, assignments)
+        epoch = datetime.datetime(2017, 1, 9)
+        semester = 16 * 7 * 24 * 3600
+        first_names = ('Ada', 'Alan', 'Grace', 'Edsger', 'Barbara', 'Donald', 'Frances',
+                       'John', 'Margaret', 'Dennis', 'Radia', 'Ken', 'Shafi', 'Guido')
+        last_names = ('Lovelace', 'Turing', 'Hopper', 'Dijkstra', 'Liskov', 'Knuth', 'Allen',
+                      'McCarthy', 'Hamilton', 'Ritchie', 'Perlman', 'Thompson', 'Goldwasser')
+        events = (('editor', 'change'), ('engine', 'run'), ('feedback', 'success'),
+                  ('feedback', 'error'), ('trace_step', 'next'), ('editor', 'blocks'))
+        
+        with db.engine.connect() as connection:
+            def next_id(model):
+                return (connection.execute(select([func.max(model.id)])).scalar() or 0) + 1
+            user_base, course_base = next_id(User), next_id(Course)
+            assignment_base, group_base = next_id(Assignment), next_id(AssignmentGroup)
+        # One instructor per course, then the students
+        instructors = courses
+        
+        def generator(table_index):
+            return random.Random(seed * 100 + table_index)
+        
+        def when(rng):
+            return epoch + datetime.timedelta(seconds=rng.randrange(semester))
+        
+        def user_rows():
+            rng = generator(1)
+            for index in range(instructors + users):
+                created = when(rng)
+                yield {'id': user_base + index, 'first_name': rng.choice(first_names),
+                       'last_name': rng.choice(last_names), 'gender': 'Unspecified',
+                       'email': 'scale{}-{}@example.edu'.format(seed, user_base + index),
+                       'picture': '', 'active': True,
+                       'date_created': created, 'date_modified': created}
+        
+        def authentication_rows():
+            for index in range(instructors + users):
+                user_id = user_base + index
+                yield {'type': 'canvas', 'user_id': user_id,
+                       'value': hashlib.sha1('scale-{}-{}'.format(seed, user_id).encode('ascii')).hexdigest()}
+        
+        def course_rows():
+            rng = generator(2)
+            for index in range(courses):
+                created = when(rng)
+                yield {'id': course_base + index, 'name': 'Course {}'.format(index + 1),
+                       'owner_id': user_base + index, 'service': 'canvas',
+                       'external_id': hashlib.sha1('scale-course-{}-{}'.format(
+                                                   seed, course_base + index).encode('ascii')).hexdigest(),
+                       'date_created': created, 'date_modified': created}
+        
+        def role_rows():
+            for index in range(courses):
+                yield {'name': 'instructor', 'user_id': user_base + index,
+                       'course_id': course_base + index}
+        
+        def assignment_rows():
+            rng = generator(3)
+            for course in range(courses):
+                for index in range(assignments):
+                    created = when(rng)
+                    yield {'id': assignment_base + course * assignments + index,
+                           'name': 'Assignment #{}'.format(index + 1),
+                           'body': 'Write a program for problem {}.'.format(index + 1),
+                           'on_start': '', 'answer': '', 'url': '',
+                           'mode': rng.choice(('blocks', 'blocks', 'text', 'maze')),
+                           'owner_id': user_base + course, 'course_id': course_base + course,
+                           'version': rng.randrange(5),
+                           'date_created': created, 'date_modified': created}
+        
+        def group_rows():
+            for course in range(courses):
+                for index in range(groups):
+                    yield {'id': group_base + course * groups + index,
+                           'name': 'Day {}'.format(index + 1),
+                           'owner_id': user_base + course, 'course_id': course_base + course}
+        
+        def membership_rows():
+            for course in range(courses):
+                for group in range(groups):
+                    start, end = group * assignments // groups, (group + 1) * assignments // groups
+                    for position, index in enumerate(range(start, end)):
+                        yield {'assignment_group_id': group_base + course * groups + group,
+                               'assignment_id': assignment_base + course * assignments + index,
+                               'position': position}
+        
+        def submission_rows():
+            rng = generator(4)
+            for index in range(users):
+                course = index % courses
+                user_id = user_base + instructors + index
+                for assignment in sorted(rng.sample(range(assignments), submissions)):
+                    created = when(rng)
+                    yield {'assignment_id': assignment_base + course * assignments + assignment,
+                           'user_id': user_id,
+                           'code': 'total = 0\nfor value in range({}):\n    total = total + value\nprint(total)'.format(rng.randrange(100)),
+                           'status': 0, 'correct': rng.random() < 0.6,
+                           'assignment_version': 0, 'version': rng.randrange(1, 200),
+                           'date_created': created,
+                           'date_modified': created + datetime.timedelta(seconds=rng.randrange(3600))}
         
+        def log_rows():
+            rng = generator(5)
+            for index in range(users):
+                course = index % courses
+                user_id = user_base + instructors + index
+                for assignment in rng.sample(range(assignments), submissions):
+                    for _ in range(logs):
+                        event, action = rng.choice(events)
+                        created = when(rng)
+                        yield {'event': event, 'action': action,
+                               'assignment_id': assignment_base + course * assignments + assignment,
+                               'user_id': user_id,
+                               'date_created': created, 'date_modified': created}
+        
+        for model, rows in ((User, user_rows), (Authentication, authentication_rows),
+                            (Course, course_rows), (Role, role_rows),
+                            (Assignment, assignment_rows), (AssignmentGroup, group_rows),
+                            (AssignmentGroupMembership, membership_rows),
+                            (Submission, submission_rows), (Log, log_rows)):
+            started = time.time()
+            with db.engine.begin() as connection:
+                count = bulk_insert(connection, model.__table__, rows(), batch_size)
+            elapsed = time.time() - started
+            print("{:>28}: {:>10} rows in {:7.1f} s ({:.0f} rows/s)".format(
+                  model.__tablename__, count, elapsed, count / max(elapsed, 1e-9)))
+        print("Complete")
+        
+
+class MigrateIndexes(Command):
+    """Adds any indexes and unique constraints missing from an existing database"""
+    option_list = (
+        Option('--dedupe', dest='dedupe', action='store_true', default=False,
+               help="Delete duplicate rows (keeping the oldest) that block a unique index"),
+    )
+    
+    def run(self, dedupe, **kwargs):
+        from sqlalchemy import inspect, func, and_
+        from models.models import Course
+        inspector = inspect(db.engine)
+        existing_tables = set(inspector.get_table_names())
+        if Course.__tablename__ in existing_tables:
+            # Native courses used to be given an empty external id, not NULL
+            native = (Course.query.filter(Course.external_id == '')
+                                  .update({'external_id': None}, synchronize_session=False))
+            db.session.commit()
+            if native:
+                print("Cleared the external id of {} native courses".format(native))
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                print("Skipping {}, the table does not exist yet".format(table.name))
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                if index.name in existing:
+                    continue
+                if index.unique:
+                    columns = list(index.columns)
+                    # Rows with a NULL in the index never conflict
+                    duplicates = (db.session.query(func.min(table.c.id), *columns)
+                                            .filter(*[column.isnot(None) for column in columns]))
+                    # Partial indexes only constrain the rows they cover
+                    where = index.kwargs.get(db.engine.dialect.name + '_where')
+                    if where is not None:
+                        duplicates = duplicates.filter(where)
+                    duplicates = (duplicates.group_by(*columns)
+                                            .having(func.count(table.c.id) > 1)
+                                            .all())
+                    if duplicates and not dedupe:
+                        print("Cannot create {}: {} duplicated {}. Rerun with --dedupe.".format(
+                              index.name, len(duplicates), tuple(c.name for c in columns)))
+                        continue
+                    for duplicate in duplicates:
+                        keep_id, values = duplicate[0], duplicate[1:]
+                        db.session.execute(table.delete().where(and_(
+                            table.c.id != keep_id,
+                            *[column == value for column, value in zip(columns, values)])))
+                    db.session.commit()
+                    if duplicates:
+                        print("Removed duplicates for {} groups in {}".format(len(duplicates), table.name))
+                index.create(db.engine)
+                print("Created {}".format(index.name))
+
+class ExportCourse(Command):
+    """Streams a course's submissions or logs to a CSV, JSON-lines or zip file"""
+    option_list = (
+        Option('--course', '-c', dest='course_id', type=int, required=True),
+        Option('--kind', '-k', dest='kind', default='submissions',
+               choices=('submissions', 'logs')),
+        Option('--format', '-f', dest='format', default='csv',
+               choices=('csv', 'jsonl', 'zip')),
+        Option('--output', '-o', dest='output', default=None,
+               help="Defaults to course-<id>-<kind>.<format>"),
+    )
+    
+    def run(self, course_id, kind, format, output, **kwargs):
+        from controllers.exports import export_chunks
+        output = output or 'course-{}-{}.{}'.format(course_id, kind, format)
+        written = 0
+        with app.app_context():
+            with open(output, 'wb') as export_file:
+                for chunk in export_chunks(course_id, kind, format):
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode('utf-8')
+                    export_file.write(chunk)
+                    written += len(chunk)
+        print("Wrote {} bytes to {}".format(written, output))
+
+class SyncReplicas(Command):
+    """Copies a SQLite primary database over its SQLite replicas, to try out replica reads locally"""
+    def run(self, **kwargs):
+        import os
+        import shutil
+        import sqlite3
+        primary_path = db.engine.url.database
+        replicas = app.config.get('SQLALCHEMY_REPLICA_BINDS') or []
+        if db.engine.dialect.name != 'sqlite' or not replicas:
+            print("Only SQLite primaries with SQLALCHEMY_REPLICA_BINDS can be synced")
+            return
+        primary = sqlite3.connect(primary_path)
+        try:
+            for name in replicas:
+                engine = db.get_engine(app, bind=name)
+                if engine.dialect.name != 'sqlite':
+                    print("Skipping {}, it is not a SQLite database".format(name))
+                    continue
+                replica_path = engine.url.database
+                if hasattr(primary, 'backup'):
+                    replica = sqlite3.connect(replica_path)
+                    try:
+                        primary.backup(replica)
+                    finally:
+                        replica.close()
+                else:
+                    # Without the backup API, copy the file; only safe while
+                    # nothing has the replica open
+                    primary.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                    for suffix in ('-wal', '-shm'):
+                        if os.path.exists(replica_path + suffix):
+                            os.remove(replica_path + suffix)
+                    shutil.copyfile(primary_path, replica_path)
+                print("Copied {} to {} ({})".format(primary_path, name, replica_path))
+        finally:
+            primary.close()
 
 class DisplayDB(Command):
     def run(self, **kwargs):
@@ -0,0 +1,103 @@
+'''
+A stand-in LMS for load testing: it builds LTI 1.1 launches signed with
+OAuth 1.0a (HMAC-SHA1), exactly as Canvas would, for a consumer from
+PYLTI_CONFIG, and serves the application (and with it the /outcome_stub/
+outcome service) on a local port so that grade posts have somewhere to go.
+'''
+
+import os
+import hmac
+import time
+import base64
+import hashlib
+import binascii
+import threading
+
+try:
+    from urllib.parse import quote, urlsplit, parse_qsl
+except ImportError:
+    from urllib import quote
+    from urlparse import urlsplit, parse_qsl
+
+
+def _encode(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return quote(value, safe='~')
+
+
+def sign(method, url, params, consumer_key, consumer_secret):
+    '''
+    Returns `params` with the oauth_* fields and an HMAC-SHA1 signature added,
+    following RFC 5849 section 3.4; any query string in `url` is signed too.
+    '''
+    signed = dict(params)
+    signed.update(oauth_consumer_key=consumer_key,
+                  oauth_nonce=binascii.hexlify(os.urandom(16)).decode('ascii'),
+                  oauth_signature_method='HMAC-SHA1',
+                  oauth_timestamp=str(int(time.time())),
+                  oauth_version='1.0')
+    parts = urlsplit(url)
+    base_url = '{}://{}{}'.format(parts.scheme.lower(), parts.netloc.lower(), parts.path)
+    pairs = sorted((_encode(key), _encode(value))
+                   for key, value in list(signed.items()) + parse_qsl(parts.query))
+    normalized = '&'.join('{}={}'.format(key, value) for key, value in pairs)
+    base_string = '&'.join([method.upper(), _encode(base_url), _encode(normalized)])
+    key = '{}&'.format(_encode(consumer_secret))
+    digest = hmac.new(key.encode('utf-8'), base_string.encode('utf-8'), hashlib.sha1).digest()
+    signed['oauth_signature'] = base64.b64encode(digest).decode('ascii')
+    return signed
+
+
+class FakeLMS(object):
+    def __init__(self, app, consumer_key=None, host='127.0.0.1', port=0):
+        consumers = app.config['PYLTI_CONFIG']['consumers']
+        self.consumer_key = consumer_key or sorted(consumers)[0]
+        self.consumer_secret = consumers[self.consumer_key]['secret']
+        self.app = app
+        self.host = host
+        self.port = port
+        self.server = None
+
+    @property
+    def outcome_url(self):
+        return 'http://{}:{}/outcome_stub/'.format(self.host, self.port)
+
+    def start(self):
+        '''
+        Serve the application in a background thread, for the outcome service.
+        '''
+        from werkzeug.serving import make_server
+        self.server = make_server(self.host, self.port, self.app, threaded=True)
+        self.port = self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever, name='FakeLMS')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+    def launch_params(self, url, user, course, resource, roles='Learner'):
+        '''
+        The signed form fields of a basic-lti-launch-request for `user` in
+        `course`, POSTed to `url`.
+        '''
+        params = {
+            'lti_message_type': 'basic-lti-launch-request',
+            'lti_version': 'LTI-1p0',
+            'resource_link_id': 'resource-{}'.format(resource),
+            'user_id': 'student-{}'.format(user),
+            'roles': roles,
+            'context_id': 'course-{}'.format(course),
+            'context_title': 'Load Test Course {}'.format(course),
+            'lis_person_name_given': 'Student',
+            'lis_person_name_family': str(user),
+            'lis_person_contact_email_primary': 'student-{}@example.edu'.format(user),
+            'lis_outcome_service_url': self.outcome_url,
+            'lis_result_sourcedid': 'sourcedid-{}-{}'.format(user, resource),
+            'launch_presentation_return_url': 'http://{}:{}/'.format(self.host, self.port),
+            'tool_consumer_instance_guid': 'fake-lms',
+        }
+        return sign('POST', url, params, self.consumer_key, self.consumer_secret)
@@ -0,0 +1,77 @@
+'''
+Import-time profile of the application. Run as
+
+    python -m scripts.startup_profile main profile.json
+
+in a fresh interpreter, it imports `main` with every import timed and writes
+the total seconds, and for each module imported along the way the seconds
+spent importing it including (cumulative) and excluding (self) the modules it
+imported in turn. `manage.py profile_startup` runs it and summarizes.
+'''
+
+import sys
+import json
+import time
+
+try:
+    import builtins
+    DEFAULT_LEVEL = 0
+except ImportError:
+    import __builtin__ as builtins
+    # Python 2's implicit relative imports
+    DEFAULT_LEVEL = -1
+
+
+def _resolve(name, globals, level):
+    if level <= 0 or not globals:
+        return name
+    package = globals.get('__package__')
+    if not package:
+        package = globals.get('__name__', '')
+        if '__path__' not in globals:
+            package = package.rpartition('.')[0]
+    for _ in range(level - 1):
+        package = package.rpartition('.')[0]
+    return '{}.{}'.format(package, name) if name else package
+
+
+def profile_imports(target):
+    '''
+    Import `target`; returns the seconds it took and {module: [cumulative
+    seconds, self seconds]} for every module imported for the first time.
+    '''
+    timings = {}
+    children = []
+    original_import = builtins.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=(), level=DEFAULT_LEVEL):
+        module_name = _resolve(name, globals, level)
+        if module_name in sys.modules:
+            return original_import(name, globals, locals, fromlist, level)
+        children.append(0.0)
+        started = time.time()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - started
+            nested = children.pop()
+            if children:
+                children[-1] += elapsed
+            timings.setdefault(module_name, [elapsed, elapsed - nested])
+
+    builtins.__import__ = timed_import
+    started = time.time()
+    try:
+        __import__(target)
+    finally:
+        builtins.__import__ = original_import
+    return time.time() - started, timings
+
+
+if __name__ == '__main__':
+    target, output = sys.argv[1], sys.argv[2]
+    total, timings = profile_imports(target)
+    with open(output, 'w') as output_file:
+        json.dump({'target': target, 'total': total,
+                   'modules': sorted([name] + times for name, times in timings.items())},
+                  output_file)
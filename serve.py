@@ -0,0 +1,205 @@
+'''
+Production server. Unlike the development servers of manage.py, it runs the
+application in one of three worker models, and on SIGTERM (or SIGINT) stops
+taking requests, lets those in flight finish, and flushes the background work
+before exiting (see controllers/lifecycle.py).
+
+    python serve.py --mode threaded   # one process, a pool of threads
+    python serve.py --mode process    # gunicorn: the application is loaded
+                                      # once, then forked into workers that
+                                      # each have a pool of threads
+    python serve.py --mode gevent     # one process, a greenlet per request
+
+The process mode uses every core, and needs gunicorn. The gevent mode suits
+many slow, I/O-bound requests (long polls, grade posts to a slow LMS), and
+needs gevent; its database driver must cooperate with gevent too, and
+SQLite's does not: a write waiting for the lock stalls the whole process.
+The gevent mode has to patch the standard library before the application is
+imported, which is why this is a script of its own rather than a manage.py
+command.
+'''
+
+import os
+import sys
+import signal
+import argparse
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+MODES = ('threaded', 'process', 'gevent')
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the application.")
+    parser.add_argument('--mode', choices=MODES, default='threaded')
+    parser.add_argument('--host', default=None, help="Defaults to HOST, or 0.0.0.0")
+    parser.add_argument('--port', type=int, default=None, help="Defaults to PORT, or 5000")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Processes, in the process mode (SERVE_WORKERS)")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="Threads per process, in the threaded and process modes (SERVE_THREADS)")
+    parser.add_argument('--connections', type=int, default=None,
+                        help="Concurrent requests, in the gevent mode (SERVE_GEVENT_CONNECTIONS)")
+    parser.add_argument('--drain-timeout', dest='drain_timeout', type=float, default=None,
+                        help="Seconds to let requests finish when stopping (SERVE_DRAIN_TIMEOUT)")
+    parser.add_argument('--database', default=None,
+                        help="Serve this database URI instead of SQLALCHEMY_DATABASE_URI "
+                             "(e.g., the scratch database of manage.py bench)")
+    parser.add_argument('--ssl', action='store_true', default=False,
+                        help="Serve HTTPS with SERVER_CERTIFICATE_FILE and SERVER_KEY_FILE")
+    return parser.parse_args(argv)
+
+
+def make_pooled_server(host, port, app, threads, ssl_context=None):
+    '''
+    Werkzeug's server, with requests handled by a fixed pool of threads
+    rather than a new thread each.
+    '''
+    from werkzeug.serving import BaseWSGIServer
+
+    class PooledWSGIServer(BaseWSGIServer):
+        multithread = True
+
+        def __init__(self):
+            BaseWSGIServer.__init__(self, host, port, app, ssl_context=ssl_context)
+            self.requests = queue.Queue()
+            self.workers = [threading.Thread(target=self._work, name='Request-{}'.format(index))
+                            for index in range(threads)]
+            for worker in self.workers:
+                worker.daemon = True
+                worker.start()
+
+        def process_request(self, request, client_address):
+            self.requests.put((request, client_address))
+
+        def _work(self):
+            while True:
+                item = self.requests.get()
+                if item is None:
+                    return
+                request, client_address = item
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        def stop_workers(self, timeout):
+            # Connections already accepted are still answered (with a 503)
+            for worker in self.workers:
+                self.requests.put(None)
+            for worker in self.workers:
+                worker.join(timeout)
+
+    return PooledWSGIServer()
+
+
+def serve_threaded(app, lifecycle, host, port, threads, drain_timeout, ssl):
+    server = make_pooled_server(host, port, app, threads,
+                                ssl_context=(ssl['certfile'], ssl['keyfile']) if ssl else None)
+
+    def stop(signum, frame):
+        lifecycle.begin_drain()
+        # shutdown() waits for serve_forever, which this thread is running
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print("Serving on {}:{} with {} threads".format(host, server.server_port, threads))
+    server.serve_forever()
+    lifecycle.shutdown(drain_timeout)
+    server.stop_workers(drain_timeout)
+    server.server_close()
+
+
+def serve_processes(app, lifecycle, host, port, workers, threads, drain_timeout, ssl):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("The process mode needs gunicorn (pip install gunicorn)")
+    options = {'bind': '{}:{}'.format(host, port),
+               'workers': workers,
+               'threads': threads,
+               'worker_class': 'gthread' if threads > 1 else 'sync',
+               # Import once in the master; workers share its memory
+               'preload_app': True,
+               'graceful_timeout': drain_timeout,
+               'post_fork': lambda server, worker: lifecycle.after_fork(),
+               # Workers have finished their requests by the time they exit
+               'worker_exit': lambda server, worker: lifecycle.flush_background_work()}
+    options.update(ssl or {})
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
+
+
+def serve_gevent(app, lifecycle, host, port, connections, drain_timeout, ssl):
+    import gevent
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    server = WSGIServer((host, port), app, spawn=Pool(connections), **(ssl or {}))
+
+    def stop():
+        lifecycle.begin_drain()
+        # Stops listening, then waits for the running requests
+        server.stop(timeout=drain_timeout)
+    # gevent.signal was renamed in gevent 1.5
+    signal_handler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    signal_handler(signal.SIGTERM, stop)
+    signal_handler(signal.SIGINT, stop)
+    print("Serving on {}:{} with up to {} connections".format(host, port, connections))
+    server.serve_forever()
+    lifecycle.shutdown(drain_timeout)
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    if arguments.mode == 'gevent':
+        try:
+            from gevent import monkey
+        except ImportError:
+            sys.exit("The gevent mode needs gevent (pip install gevent)")
+        monkey.patch_all()
+
+    from main import app
+    from controllers import lifecycle
+    from controllers.metrics import remove_stale_metrics
+    config = app.config
+    if arguments.database:
+        config['SQLALCHEMY_DATABASE_URI'] = arguments.database
+    host = arguments.host or config.get('HOST', '0.0.0.0')
+    port = arguments.port or config.get('PORT', 5000)
+    drain_timeout = arguments.drain_timeout or config.get('SERVE_DRAIN_TIMEOUT', 30)
+    threads = arguments.threads or config.get('SERVE_THREADS', 8)
+    ssl = None
+    if arguments.ssl:
+        ssl = {'certfile': config['SERVER_CERTIFICATE_FILE'],
+               'keyfile': config['SERVER_KEY_FILE']}
+
+    # Counts from an earlier run of the server would be added to this one's
+    remove_stale_metrics(config['METRICS_DIR'])
+    lifecycle.server_pid = os.getpid()
+    if arguments.mode == 'threaded':
+        serve_threaded(app, lifecycle, host, port, threads, drain_timeout, ssl)
+    elif arguments.mode == 'process':
+        workers = arguments.workers or config.get('SERVE_WORKERS') or multiprocessing.cpu_count()
+        serve_processes(app, lifecycle, host, port, workers, threads, drain_timeout, ssl)
+    else:
+        connections = arguments.connections or config.get('SERVE_GEVENT_CONNECTIONS', 1000)
+        serve_gevent(app, lifecycle, host, port, connections, drain_timeout, ssl)
+
+
+if __name__ == '__main__':
+    main()